@@ -1,6 +1,6 @@
 {
     "name": "Global Lines",
-    "version": "15.0.1.0.0",
+    "version": "15.0.1.1.0",
     "author": "Munin",
     "summary": "Global Lines",
     "depends": ["l10n_mx_edi_40"],
@@ -8,7 +8,10 @@
     "data": [
         "security/ir.model.access.csv",
         "data/cfdi.xml",
+        "data/ir_cron.xml",
+        "wizard/account_global_line_import_views.xml",
         "views/account_global_line_views.xml",
+        "views/account_global_export_metric_views.xml",
     ],
     "installable": True,
     "license": "AGPL-3",
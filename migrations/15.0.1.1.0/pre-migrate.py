@@ -0,0 +1,63 @@
+import logging
+
+_logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100000
+
+
+def _fill_by_batches(cr, query):
+    cr.execute("SELECT MIN(id), MAX(id) FROM account_global_line")
+    min_id, max_id = cr.fetchone()
+    if min_id is None:
+        return
+    for start in range(min_id, max_id + 1, BATCH_SIZE):
+        cr.execute(query, {'start': start, 'stop': start + BATCH_SIZE})
+
+
+def migrate(cr, version):
+    ''' Create and fill the new stored related fields of account.global.line by batches and the stored total of the
+    global lines on account.move, in SQL, so the ORM doesn't compute them record by record when updating the module.
+    '''
+    if not version:
+        return
+
+    _logger.info("Storing the currency, date and unit of measure category of the global lines.")
+    cr.execute('''
+        ALTER TABLE account_global_line
+            ADD COLUMN IF NOT EXISTS currency_id INTEGER,
+            ADD COLUMN IF NOT EXISTS date DATE,
+            ADD COLUMN IF NOT EXISTS product_uom_category_id INTEGER
+    ''')
+    _fill_by_batches(cr, '''
+        UPDATE account_global_line line
+        SET currency_id = move.currency_id,
+            date = move.date
+        FROM account_move move
+        WHERE move.id = line.move_id
+        AND line.id >= %(start)s
+        AND line.id < %(stop)s
+    ''')
+    _fill_by_batches(cr, '''
+        UPDATE account_global_line line
+        SET product_uom_category_id = uom.category_id
+        FROM product_product product
+        JOIN product_template template ON template.id = product.product_tmpl_id
+        JOIN uom_uom uom ON uom.id = template.uom_id
+        WHERE product.id = line.product_id
+        AND line.id >= %(start)s
+        AND line.id < %(stop)s
+    ''')
+
+    _logger.info("Storing the total of the global lines of the journal entries.")
+    cr.execute("ALTER TABLE account_move ADD COLUMN IF NOT EXISTS amount_total_concept NUMERIC")
+    cr.execute('''
+        UPDATE account_move move
+        SET amount_total_concept = totals.total
+        FROM (
+            SELECT move_id, SUM(price_total) AS total
+            FROM account_global_line
+            GROUP BY move_id
+        ) AS totals
+        WHERE totals.move_id = move.id
+    ''')
+    cr.execute("UPDATE account_move SET amount_total_concept = 0.0 WHERE amount_total_concept IS NULL")
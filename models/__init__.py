@@ -1,3 +1,8 @@
 from . import account_edi_format
 from . import account_global_line
+from . import account_global_line_summary
+from . import account_global_line_source
+from . import account_global_export_metric
+from . import account_global_export_job
 from . import account_move
+from . import account_tax
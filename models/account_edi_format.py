@@ -1,27 +1,209 @@
 from odoo import api, models, fields, tools, _
-from odoo.tools.xml_utils import _check_with_xsd
+from odoo.exceptions import UserError
 from odoo.tools.float_utils import float_round, float_is_zero
+from odoo.tools import config
+from odoo.tools.lru import LRU
 
 import logging
+import multiprocessing
+import os
 import re
 import base64
+import hashlib
 import json
 import requests
 import random
 import string
+import tempfile
 
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
+from OpenSSL import crypto
 from lxml.objectify import fromstring
 from math import copysign
 from datetime import datetime
+from decimal import Decimal
 from io import BytesIO
 from json.decoder import JSONDecodeError
 
 from odoo.tools.zeep import Client
 
+from .account_global_export_metric import GlobalExportProfiler, NULL_PROFILER
+from .global_edi_values import GlobalLineEdiTable
+from . import global_tax_engine
+
 _logger = logging.getLogger(__name__)
 EQUIVALENCIADR_PRECISION_DIGITS = 10
 CFDI_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+CFDI_NAMESPACES = {
+    'cfdi': 'http://www.sat.gob.mx/cfd/4',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+    'cce20': 'http://www.sat.gob.mx/ComercioExterior20',
+}
+CFDI_SCHEMA_LOCATION = 'http://www.sat.gob.mx/cfd/4 http://www.sat.gob.mx/sitio_internet/cfd/4/cfdv40.xsd ' \
+                       'http://www.sat.gob.mx/ComercioExterior20 ' \
+                       'http://www.sat.gob.mx/sitio_internet/cfd/ComercioExterior20/ComercioExterior20.xsd'
+
+
+def _cfdi_tag(name):
+    return '{%s}%s' % (CFDI_NAMESPACES['cfdi'], name)
+
+
+def _cfdi_attrib(values):
+    # Same as the 't-att' of QWeb: None and False values don't produce any attribute.
+    return {key: str(value) for key, value in values if value is not None and value is not False}
+
+
+# Compiled XSD schemas and cadena XSLT, shared by all the exports of the worker process.
+_XSD_SCHEMA_CACHE = LRU(8)
+_XSLT_CACHE = LRU(8)
+
+
+def _get_xsd_schema(checksum, get_xsd_datas):
+    ''' Return the compiled XSD schema of the attachment having the given checksum. 'get_xsd_datas' returns the
+    content of the schema and is only called when the schema is not compiled yet.
+    '''
+    schema = _XSD_SCHEMA_CACHE.get(checksum)
+    if schema is None:
+        xsd_datas = get_xsd_datas()
+        if not xsd_datas:
+            raise IOError("Empty XSD file")
+        with BytesIO(xsd_datas) as xsd:
+            schema = etree.XMLSchema(etree.parse(xsd, parser=etree.XMLParser()))
+        _XSD_SCHEMA_CACHE[checksum] = schema
+    return schema
+
+
+def _check_with_cached_xsd(cfdi_node, checksum, get_xsd_datas):
+    ''' Same as '_check_with_xsd' but the schema is only compiled once per process. '''
+    schema = _get_xsd_schema(checksum, get_xsd_datas)
+    try:
+        schema.assertValid(cfdi_node)
+    except etree.DocumentInvalid as xml_errors:
+        raise UserError('\n'.join(str(e) for e in xml_errors.error_log))
+
+
+def _get_cadena_xslt(path):
+    ''' Return the compiled XSLT at 'path' producing the cadena original, recompiled only when the file changes. '''
+    with tools.file_open(path, 'rb') as xslt_file:
+        key = (xslt_file.name, os.path.getmtime(xslt_file.name))
+        transform = _XSLT_CACHE.get(key)
+        if transform is None:
+            transform = etree.XSLT(etree.parse(xslt_file))
+            _XSLT_CACHE[key] = transform
+    return transform
+
+
+def _seal_global_cfdi_node(cfdi_node, sign, cadena_xslt_path, xsd_checksum=None, get_xsd_datas=None,
+                           profiler=NULL_PROFILER):
+    ''' Compute the cadena of an unsigned global CFDI, seal it, serialize it and validate it against the XSD.
+    Nothing here uses the ORM so it can run in another process, see '_seal_global_cfdi'.
+
+    :param cfdi_node:       The parsed unsigned CFDI.
+    :param sign:            A callable returning the base64 encoded signature of a cadena.
+    :param cadena_xslt_path: The path of the XSLT producing the cadena of the Comprobante, the second one of
+                            '_l10n_mx_edi_get_cadena_xslts'.
+    :param xsd_checksum:    The checksum of the XSD attachment, no validation if not set.
+    :param get_xsd_datas:   A callable returning the content of the XSD attachment, see '_get_xsd_schema'.
+    :param profiler:        The profiler timing the stages, see 'account.global.export.metric'.
+    :return: A dict with the 'cfdi_str' and the optional 'errors', as '_l10n_mx_edi_export_invoice_cfdi'.
+    '''
+    with profiler.stage('cadena'):
+        cadena = str(_get_cadena_xslt(cadena_xslt_path)(cfdi_node))
+    with profiler.stage('seal'):
+        cfdi_node.attrib['Sello'] = sign(cadena)
+
+    with profiler.stage('serialize'):
+        res = {
+            'cfdi_str': etree.tostring(cfdi_node, pretty_print=True, xml_declaration=True, encoding='UTF-8'),
+        }
+    profiler.xml_size = len(res['cfdi_str'])
+
+    # == Optional check using the XSD ==
+    if xsd_checksum:
+        with profiler.stage('xsd'):
+            try:
+                _check_with_cached_xsd(cfdi_node, xsd_checksum, get_xsd_datas or (lambda: None))
+            except (IOError, ValueError):
+                _logger.info(_('The xsd file to validate the XML structure was not found'))
+            except Exception as e:
+                res['errors'] = str(e).split('\\n')
+
+    return res
+
+
+def _get_global_cfdi_totals(cfdi_node):
+    ''' Read the totals written in a rendered global CFDI and check that they add up the way the SAT validates them:
+    the total from the subtotal, discount and taxes, the subtotal and discount from the concepts and the tax summary
+    from the taxes of the concepts. The amounts are compared as written, with decimals.
+
+    :param cfdi_node: The parsed CFDI.
+    :return: A tuple (totals, errors) with a python dict of the totals and a list of errors.
+    '''
+    namespaces = {'cfdi': CFDI_NAMESPACES['cfdi']}
+
+    def get_amount(node, attribute):
+        return Decimal(node.get(attribute) or '0') if node is not None else Decimal(0)
+
+    def get_sum(xpath, attribute):
+        return sum((get_amount(node, attribute) for node in cfdi_node.iterfind(xpath, namespaces)), Decimal(0))
+
+    summary = cfdi_node.find('cfdi:Impuestos', namespaces)
+    totals = {
+        'subtotal': get_amount(cfdi_node, 'SubTotal'),
+        'discount': get_amount(cfdi_node, 'Descuento'),
+        'transferred': get_amount(summary, 'TotalImpuestosTrasladados'),
+        'withholding': get_amount(summary, 'TotalImpuestosRetenidos'),
+        'total': get_amount(cfdi_node, 'Total'),
+    }
+    errors = []
+
+    computed_total = totals['subtotal'] - totals['discount'] + totals['transferred'] - totals['withholding']
+    if computed_total != totals['total']:
+        errors.append(f"El Total {totals['total']} del CFDI no es igual a SubTotal - Descuento + Impuestos: {computed_total}")
+
+    concepts_amount = get_sum('cfdi:Conceptos/cfdi:Concepto', 'Importe')
+    if concepts_amount != totals['subtotal']:
+        errors.append(f"El SubTotal {totals['subtotal']} del CFDI no es igual a la suma de los conceptos: {concepts_amount}")
+    concepts_discount = get_sum('cfdi:Conceptos/cfdi:Concepto', 'Descuento')
+    if concepts_discount != totals['discount']:
+        errors.append(f"El Descuento {totals['discount']} del CFDI no es igual a la suma de los conceptos: {concepts_discount}")
+
+    for tax_type, path, label in (
+        ('transferred', 'cfdi:Traslados/cfdi:Traslado', 'trasladados'),
+        ('withholding', 'cfdi:Retenciones/cfdi:Retencion', 'retenidos'),
+    ):
+        summary_amount = get_sum('cfdi:Impuestos/' + path, 'Importe')
+        concepts_tax_amount = get_sum('cfdi:Conceptos/cfdi:Concepto/cfdi:Impuestos/' + path, 'Importe')
+        if summary_amount != totals[tax_type]:
+            errors.append(f"El total de impuestos {label} {totals[tax_type]} del CFDI no es igual a la suma del resumen: {summary_amount}")
+        if concepts_tax_amount != totals[tax_type]:
+            errors.append(f"El total de impuestos {label} {totals[tax_type]} del CFDI no es igual a la suma de los conceptos: {concepts_tax_amount}")
+    return totals, errors
+
+
+def _init_global_cfdi_worker(xsd_checksum, xsd_datas):
+    ''' Initializer of the export processes: compile the XSD once per process. '''
+    if xsd_checksum:
+        try:
+            _get_xsd_schema(xsd_checksum, lambda: xsd_datas)
+        except Exception:
+            _logger.exception("Unable to compile the CFDI XSD schema")
+
+
+def _seal_global_cfdi(payload):
+    ''' Process pool entry point of '_seal_global_cfdi_node'.
+
+    :param payload: A dict with the unsigned 'cfdi' bytes, the 'key_pem' of the certificate, the
+                    'cadena_xslt_path' and the 'xsd_checksum'.
+    '''
+    cfdi_node = etree.fromstring(payload['cfdi'], etree.XMLParser(remove_blank_text=True, huge_tree=True))
+    private_key = crypto.load_privatekey(crypto.FILETYPE_PEM, payload['key_pem'])
+
+    def sign(cadena):
+        return base64.b64encode(crypto.sign(private_key, cadena, 'sha256WithRSAEncryption'))
+
+    return _seal_global_cfdi_node(cfdi_node, sign, payload['cadena_xslt_path'], xsd_checksum=payload['xsd_checksum'])
 
 
 class AccountEdiFormat(models.Model):
@@ -31,90 +213,562 @@ class AccountEdiFormat(models.Model):
         return self.env.ref('global_concepts.cfdiv40Global'), self.sudo().env.ref('l10n_mx_edi.xsd_cached_cfdv40_xsd', False)
 
     def _l10n_mx_edi_get_invoice_cfdi_values(self, invoice):
-        res = super()._l10n_mx_edi_get_invoice_cfdi_values(invoice)
+        profiler = self._context.get('l10n_mx_edi_global_profiler', NULL_PROFILER)
+        with profiler.stage('prepare_edi_vals'):
+            res = super()._l10n_mx_edi_get_invoice_cfdi_values(invoice)
         if invoice.is_global_concept:
-            tax_values = {
-                'tax_details_transferred_global': self.get_tax_detail_transferred_global(res),
-                'tax_details_withholding_global': self.get_tax_details_withholding_global(res)
-            }
+            with profiler.stage('tax_details'):
+                tax_values = {
+                    'tax_details_transferred_global': self.get_tax_detail_transferred_global(res),
+                    'tax_details_withholding_global': self.get_tax_details_withholding_global(res)
+                }
             res.update(tax_values)
         return res
 
+    def _get_global_tax_totals_empty(self):
+        return {
+            'base_amount_currency': 0.0,
+            'tax_amount_currency': 0.0,
+            'base_amount': 0.0,
+            'tax_amount': 0.0,
+            'tax_details': []
+        }
+
+    def _get_global_tax_totals(self, data, tax_lines):
+        ''' Sum the amounts of 'tax_lines' in minor units, see 'global_tax_engine'.
+
+        :return: A python dict with the totals in minor units of the invoice currency and of the company currency.
+        '''
+        invoice = data['record']
+        digits = invoice.currency_id.decimal_places
+        company_digits = invoice.company_id.currency_id.decimal_places
+        totals = {'base_amount_currency': 0, 'tax_amount_currency': 0, 'base_amount': 0, 'tax_amount': 0}
+        for tax_line in tax_lines:
+            totals['base_amount_currency'] += global_tax_engine.to_minor_units(tax_line.get('base_amount_currency', 0.0), digits)
+            totals['tax_amount_currency'] += global_tax_engine.to_minor_units(tax_line.get('tax_amount_currency', 0.0), digits)
+            totals['base_amount'] += global_tax_engine.to_minor_units(tax_line.get('base_amount', 0.0), company_digits)
+            totals['tax_amount'] += global_tax_engine.to_minor_units(tax_line.get('tax_amount', 0.0), company_digits)
+        return totals
+
+    def _get_global_tax_totals_values(self, data, totals, tax_details):
+        invoice = data['record']
+        digits = invoice.currency_id.decimal_places
+        company_digits = invoice.company_id.currency_id.decimal_places
+        return {
+            'base_amount_currency': global_tax_engine.from_minor_units(totals['base_amount_currency'], digits),
+            'tax_amount_currency': global_tax_engine.from_minor_units(totals['tax_amount_currency'], digits),
+            'base_amount': global_tax_engine.from_minor_units(totals['base_amount'], company_digits),
+            'tax_amount': global_tax_engine.from_minor_units(totals['tax_amount'], company_digits),
+            'tax_details': tax_details
+        }
+
     def get_tax_detail_transferred_global(self, data):
-        base_amount_currency = 0.0
-        tax_amount_currency = 0.0
-        base_amount = 0.0
-        tax_amount = 0.0
+        tax_context = data.get('global_tax_context')
+        if tax_context and not tax_context['transferred']['taxes']:
+            # No transferred tax on the invoice, the details of every line are empty.
+            return self._get_global_tax_totals_empty()
+        line_vals_list = data.get('invoice_line_vals_list', [])
+        if isinstance(line_vals_list, GlobalLineEdiTable):
+            # The totals are computed in bulk from the subtotals of the compact table and the details on access, don't
+            # keep them all in memory.
+            totals = global_tax_engine.compute_tax_totals(line_vals_list.price_subtotal, tax_context, 'transferred')
+            return self._get_global_tax_totals_values(data, totals, line_vals_list.get_tax_details('transferred'))
+
         tax_details = []
-        for line in data.get('invoice_line_vals_list', []):
+        for line in line_vals_list:
             tax_detail_transferred_global = line.get('tax_details_transferred_global', {})
-            for tax_line in tax_detail_transferred_global.get("tax_details", []):
-                base_amount_currency += tax_line.get('base_amount_currency', 0.0)
-                tax_amount_currency += tax_line.get('tax_amount_currency', 0.0)
-                base_amount += tax_line.get('base_amount', 0.0)
-                tax_amount += tax_line.get('tax_amount', 0.0)
-                tax_details.append(tax_line)
-        values = {
-            'base_amount_currency': base_amount_currency,
-            'tax_amount_currency': tax_amount_currency,
-            'base_amount': base_amount,
-            'tax_amount': tax_amount,
-            'tax_details': tax_details
-        }
-        return values
+            tax_details += tax_detail_transferred_global.get("tax_details", [])
+        totals = self._get_global_tax_totals(data, tax_details)
+        return self._get_global_tax_totals_values(data, totals, tax_details)
 
     def get_tax_details_withholding_global(self, data):
-        base_amount_currency = 0.0
-        tax_amount_currency = 0.0
-        base_amount = 0.0
-        tax_amount = 0.0
+        tax_context = data.get('global_tax_context')
+        if tax_context and not tax_context['withholding']['taxes']:
+            # No withholding tax on the invoice, the details of every line are empty.
+            return self._get_global_tax_totals_empty()
+        line_vals_list = data.get('invoice_line_vals_list', [])
+        if isinstance(line_vals_list, GlobalLineEdiTable):
+            # Same as 'get_tax_detail_transferred_global'.
+            totals = global_tax_engine.compute_tax_totals(line_vals_list.price_subtotal, tax_context, 'withholding')
+            return self._get_global_tax_totals_values(data, totals, line_vals_list.get_tax_details('withholding'))
+
         tax_details = []
-        for line in data.get('invoice_line_vals_list', []):
-            tax_details_withholding = line.get('tax_details_withholding', {})
-            for tax_line in tax_details_withholding.get('tax_details', []):
-                base_amount_currency += tax_line.get('base_amount_currency', 0.0)
-                tax_amount_currency += tax_line.get('tax_amount_currency', 0.0)
-                base_amount += tax_line.get('base_amount', 0.0)
-                tax_amount += tax_line.get('tax_amount', 0.0)
-                tax_details.append(tax_line.get('tax_details'))
-        values = {
-            'base_amount_currency': base_amount_currency,
-            'tax_amount_currency': tax_amount_currency,
-            'base_amount': base_amount,
-            'tax_amount': tax_amount,
-            'tax_details': tax_details
-        }
-        return values
+        for line in line_vals_list:
+            tax_detail_withholding_global = line.get('tax_details_withholding_global', {})
+            tax_details += tax_detail_withholding_global.get("tax_details", [])
+        totals = self._get_global_tax_totals(data, tax_details)
+        return self._get_global_tax_totals_values(data, totals, tax_details)
+
+    def _l10n_mx_edi_get_global_cfdi_writer(self):
+        ''' Return how the global CFDI is generated: 'qweb' renders the 'cfdiv40Global' template, 'stream' writes
+        it incrementally with '_l10n_mx_edi_write_global_cfdi'.
+        '''
+        return self.env['ir.config_parameter'].sudo().get_param('global_concepts.cfdi_writer', 'qweb')
+
+    def _l10n_mx_edi_write_global_cfdi(self, cfdi_values, output):
+        ''' Write the unsigned global CFDI into the file object 'output' incrementally: every node is written as soon
+        as it is built, the concepts one by one, instead of rendering the whole document as a string.
+        The produced XML is equivalent to the rendering of the 'cfdiv40Global' template. All the nodes are written with
+        'xf.element' so the 'cfdi' prefix declared on 'cfdi:Comprobante' is used by all of them.
+
+        :param cfdi_values: The values returned by '_l10n_mx_edi_get_invoice_cfdi_values'.
+        :param output:      A binary file object.
+        '''
+        format_string = cfdi_values['format_string']
+        format_float = cfdi_values['format_float']
+        record = cfdi_values['record']
+        supplier = cfdi_values['supplier']
+        customer = cfdi_values['customer']
+        issued_address = cfdi_values['issued_address']
+        currency_precision = cfdi_values['currency_precision']
+        tax_objected = cfdi_values['tax_objected']
+        balance_multiplicator = cfdi_values['balance_multiplicator']
+        total_price_discount = cfdi_values['total_price_discount']
+        transferred_global = cfdi_values['tax_details_transferred_global']
+        withholding_global = cfdi_values['tax_details_withholding_global']
+
+        with etree.xmlfile(output, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            comprobante_attrib = _cfdi_attrib([
+                ('{%s}schemaLocation' % CFDI_NAMESPACES['xsi'], CFDI_SCHEMA_LOCATION),
+                ('Version', '4.0'),
+                ('Fecha', cfdi_values['cfdi_date']),
+                ('Folio', format_string(cfdi_values.get('folio_number'), 40)),
+                ('Serie', format_string(cfdi_values.get('serie_number'), 25)),
+                ('Sello', ''),
+                ('FormaPago', cfdi_values.get('payment_method_code')),
+                ('NoCertificado', cfdi_values['certificate_number']),
+                ('Certificado', cfdi_values['certificate_key']),
+                ('CondicionesDePago', format_string(record.invoice_payment_term_id.name, 1000)),
+                ('SubTotal', format_float(
+                    cfdi_values['total_price_subtotal_before_discount'] if tax_objected == '02'
+                    else record.amount_total + total_price_discount, currency_precision)),
+                ('Descuento', format_float(total_price_discount, currency_precision)
+                    if not record.currency_id.is_zero(total_price_discount) else None),
+                ('Moneda', cfdi_values['currency_name']),
+                ('TipoCambio', format_float(cfdi_values.get('currency_conversion_rate'), 6)),
+                ('Total', format_float(record.amount_total, currency_precision)),
+                ('TipoDeComprobante', cfdi_values['document_type']),
+                ('Exportacion', cfdi_values.get('l10n_mx_edi_external_trade_type')),
+                ('MetodoPago', cfdi_values['payment_policy']),
+                ('LugarExpedicion', issued_address.zip or supplier.zip),
+            ])
+            with xf.element(_cfdi_tag('Comprobante'), comprobante_attrib, nsmap=CFDI_NAMESPACES):
+                if cfdi_values.get('origin_uuids'):
+                    with xf.element(_cfdi_tag('CfdiRelacionados'), _cfdi_attrib([
+                        ('TipoRelacion', cfdi_values.get('origin_type')),
+                    ])):
+                        for uuid in cfdi_values.get('origin_uuids'):
+                            with xf.element(_cfdi_tag('CfdiRelacionado'), _cfdi_attrib([('UUID', uuid)])):
+                                pass
+
+                with xf.element(_cfdi_tag('Emisor'), _cfdi_attrib([
+                    ('Rfc', supplier.vat),
+                    ('Nombre', format_string(cfdi_values.get('supplier_name'), 254)),
+                    ('RegimenFiscal', record.company_id.l10n_mx_edi_fiscal_regime),
+                ])):
+                    pass
+                with xf.element(_cfdi_tag('Receptor'), _cfdi_attrib([
+                    ('Rfc', cfdi_values.get('customer_rfc')),
+                    ('Nombre', format_string(cfdi_values.get('customer_name'), 254)),
+                    ('ResidenciaFiscal', cfdi_values.get('customer_fiscal_residence')),
+                    ('DomicilioFiscalReceptor', customer.zip if customer.country_id.code == 'MX'
+                        else issued_address.zip or supplier.zip),
+                    ('RegimenFiscalReceptor', cfdi_values.get('fiscal_regime')),
+                    ('UsoCFDI', record.l10n_mx_edi_usage if record.l10n_mx_edi_usage != 'P01' else 'S01'),
+                ])):
+                    pass
+
+                with xf.element(_cfdi_tag('Conceptos')):
+                    for line_values in cfdi_values['invoice_line_vals_list']:
+                        self._l10n_mx_edi_write_global_concept(xf, cfdi_values, line_values)
+
+                if tax_objected == '02' and (transferred_global['tax_details'] or withholding_global['tax_details']):
+                    with xf.element(_cfdi_tag('Impuestos'), _cfdi_attrib([
+                        ('TotalImpuestosTrasladados', format_float(
+                            balance_multiplicator * transferred_global['tax_amount_currency'], currency_precision)
+                            if cfdi_values.get('has_tax_details_transferred_no_exento') else None),
+                        ('TotalImpuestosRetenidos', format_float(
+                            -balance_multiplicator * withholding_global['tax_amount_currency'], currency_precision)
+                            if cfdi_values.get('has_tax_details_withholding_no_exento') else None),
+                    ])):
+                        if withholding_global['tax_details']:
+                            with xf.element(_cfdi_tag('Retenciones')):
+                                for tax_detail_vals in withholding_global['tax_details']:
+                                    with xf.element(_cfdi_tag('Retencion'), _cfdi_attrib([
+                                        ('Importe', format_float(
+                                            -balance_multiplicator * tax_detail_vals['tax_amount_currency'],
+                                            currency_precision)),
+                                        ('Impuesto', tax_detail_vals['cfdi_name']),
+                                    ])):
+                                        pass
+                        if transferred_global['tax_details']:
+                            with xf.element(_cfdi_tag('Traslados')):
+                                for tax_detail_vals in transferred_global['tax_details']:
+                                    tax = tax_detail_vals['tax']
+                                    with xf.element(_cfdi_tag('Traslado'), _cfdi_attrib([
+                                        ('Base', format_float(
+                                            balance_multiplicator * tax_detail_vals['base_amount_currency'],
+                                            currency_precision)),
+                                        ('Importe', format_float(
+                                            balance_multiplicator * tax_detail_vals['tax_amount_currency'],
+                                            currency_precision)
+                                            if tax.l10n_mx_tax_type != 'Exento' else False),
+                                        ('Impuesto', tax_detail_vals['cfdi_name']),
+                                        ('TipoFactor', tax.l10n_mx_tax_type),
+                                        ('TasaOCuota', format_float(tax_detail_vals['tax_rate_transferred'], 6)),
+                                    ])):
+                                        pass
+
+    def _l10n_mx_edi_write_global_concept(self, xf, cfdi_values, line_values):
+        ''' Write the 'cfdi:Concepto' node of a global concept, see '_l10n_mx_edi_write_global_cfdi'. '''
+        format_string = cfdi_values['format_string']
+        format_float = cfdi_values['format_float']
+        currency_precision = cfdi_values['currency_precision']
+        tax_objected = cfdi_values['tax_objected']
+        balance_multiplicator = cfdi_values['balance_multiplicator']
+        record = cfdi_values['record']
+        line = line_values['line']
+        price_discount = line_values['price_discount']
+        price_subtotal_before_discount = line_values['price_subtotal_before_discount']
+
+        concepto_attrib = _cfdi_attrib([
+            ('ClaveProdServ', line.product_id.unspsc_code_id.code),
+            ('NoIdentificacion', format_string(line.product_id.default_code)),
+            ('Cantidad', format_float(line_values['quantity'], 6)),
+            ('ClaveUnidad', line.product_uom_id.unspsc_code_id.code),
+            ('Unidad', format_string(line.product_uom_id.name, 20).upper() if line.product_uom_id.name else None),
+            ('Descripcion', format_string(line.name, 1000)),
+            ('ValorUnitario', format_float(
+                line_values['gross_price_total_unit'] if tax_objected == '02'
+                else (line_values['price_total'] + price_discount) / line_values['quantity'], currency_precision)),
+            ('Importe', format_float(
+                price_subtotal_before_discount if tax_objected == '02'
+                else line_values['price_total'] + price_discount, currency_precision)),
+            ('ObjetoImp', '01' if (price_discount == price_subtotal_before_discount or not line['tax_ids'])
+                else tax_objected),
+            ('Descuento', format_float(price_discount, currency_precision)
+                if not record.currency_id.is_zero(price_discount) else None),
+        ])
+
+        tax_detail_transferred = line_values['tax_details_transferred_global']
+        tax_detail_withholding = line_values['tax_details_withholding_global']
+        with xf.element(_cfdi_tag('Concepto'), concepto_attrib):
+            if not (tax_detail_transferred['tax_details'] or tax_detail_withholding['tax_details']) \
+                    or tax_objected != '02' or price_discount == price_subtotal_before_discount:
+                return
+            with xf.element(_cfdi_tag('Impuestos')):
+                if tax_detail_transferred['tax_details']:
+                    with xf.element(_cfdi_tag('Traslados')):
+                        for tax_detail_vals in tax_detail_transferred['tax_details']:
+                            tax = tax_detail_vals['tax']
+                            with xf.element(_cfdi_tag('Traslado'), _cfdi_attrib([
+                                ('Base', format_float(
+                                    balance_multiplicator * tax_detail_vals['base_amount_currency'], currency_precision)),
+                                ('Importe', format_float(balance_multiplicator * tax_detail_vals['tax_amount_currency'], 2)
+                                    if tax.l10n_mx_tax_type != 'Exento' else False),
+                                ('Impuesto', tax_detail_vals['cfdi_name']),
+                                ('TipoFactor', tax.l10n_mx_tax_type),
+                                ('TasaOCuota', format_float(tax_detail_vals['tax_rate_transferred'], 6)),
+                            ])):
+                                pass
+                if tax_detail_withholding['tax_details']:
+                    with xf.element(_cfdi_tag('Retenciones')):
+                        for tax_detail_vals in tax_detail_withholding['tax_details']:
+                            tax = tax_detail_vals['tax']
+                            with xf.element(_cfdi_tag('Retencion'), _cfdi_attrib([
+                                ('Base', format_float(
+                                    balance_multiplicator * tax_detail_vals['base_amount_currency'], currency_precision)),
+                                ('Impuesto', tax_detail_vals['cfdi_name']),
+                                ('TipoFactor', tax.l10n_mx_tax_type),
+                                ('TasaOCuota', format_float(tax_detail_vals['tax_rate_withholding'], 6)),
+                                ('Importe', format_float(-balance_multiplicator * tax_detail_vals['tax_amount_currency'], 2)),
+                            ])):
+                                pass
+
+    def _l10n_mx_edi_render_global_cfdi_stream(self, cfdi_values):
+        ''' Generate the unsigned global CFDI with '_l10n_mx_edi_write_global_cfdi' through a temporary file.
+        Only the rendering is incremental: the document is parsed back as a whole because the cadena XSLT and the XSD
+        validation need the full tree, so the peak of memory is still the size of the parsed tree. The gain is not to
+        hold the rendered string of the template next to it.
+
+        :return: The parsed cfdi node.
+        '''
+        parser = etree.XMLParser(remove_blank_text=True, huge_tree=True)
+        with tempfile.TemporaryFile() as cfdi_file:
+            self._l10n_mx_edi_write_global_cfdi(cfdi_values, cfdi_file)
+            cfdi_file.seek(0)
+            return etree.parse(cfdi_file, parser).getroot()
+
+    def _l10n_mx_edi_render_global_cfdi(self, cfdi_values):
+        ''' Generate the unsigned global CFDI with the configured writer.
+
+        :return: The parsed cfdi node.
+        '''
+        if self._l10n_mx_edi_get_global_cfdi_writer() == 'stream':
+            return self._l10n_mx_edi_render_global_cfdi_stream(cfdi_values)
+        qweb_template = self._l10n_mx_edi_get_invoice_templates_global()[0]
+        cfdi = qweb_template._render(cfdi_values)
+        # Parsed the same way as '_l10n_mx_edi_decode_cfdi' but without recompiling the cadena XSLT.
+        return etree.fromstring(cfdi, etree.XMLParser(remove_blank_text=True, huge_tree=True))
+
+    def _l10n_mx_edi_get_global_cfdi_cache_key(self, invoice):
+        ''' Hash everything the global CFDI of 'invoice' is generated from: the invoice, its global lines, taxes and
+        journal items, the certificate, the template, the XSD, the writer and the version of the module. The key changes
+        as soon as one of them changes.
+        '''
+        qweb_template, xsd_attachment = self._l10n_mx_edi_get_invoice_templates_global()
+        certificate = invoice.company_id.l10n_mx_edi_certificate_ids.sudo()._get_valid_certificate()
+        module = self.env['ir.module.module'].sudo().search([('name', '=', 'global_concepts')], limit=1)
+        cache_fields = [fname for fname in invoice._get_global_cfdi_cache_fields() if fname in invoice._fields]
+        values = [
+            invoice.id,
+            [(fname, invoice[fname].ids if invoice._fields[fname].relational else invoice[fname])
+             for fname in cache_fields],
+            invoice._get_global_cfdi_digest(),
+            [invoice.partner_id.commercial_partner_id.write_date, invoice.company_id.partner_id.write_date],
+            [certificate.id, certificate.write_date],
+            [qweb_template.id, qweb_template.write_date],
+            xsd_attachment.checksum if xsd_attachment else None,
+            self._l10n_mx_edi_get_global_cfdi_writer(),
+            module.latest_version,
+        ]
+        return hashlib.sha256(json.dumps(values, default=str).encode()).hexdigest()
+
+    def _l10n_mx_edi_has_global_cfdi_cache(self, invoice, cache_key):
+        ''' Tell if a CFDI is cached for 'cache_key' by comparing the keys, without reading the cached CFDI. '''
+        return bool(cache_key) and invoice.global_cfdi_cache_key == cache_key \
+            and bool(invoice.with_context(bin_size=True).global_cfdi_cache_file)
+
+    def _l10n_mx_edi_get_global_cfdi_cache(self, invoice, cache_key):
+        ''' Return the result of '_l10n_mx_edi_export_invoice_cfdi' cached for 'cache_key', None if there is none. '''
+        if not self._l10n_mx_edi_has_global_cfdi_cache(invoice, cache_key):
+            return None
+        cfdi_file = invoice.with_context(bin_size=False).global_cfdi_cache_file
+        return {'cfdi_str': base64.b64decode(cfdi_file)} if cfdi_file else None
 
     def _l10n_mx_edi_export_invoice_cfdi(self, invoice):
         if not invoice.is_global_concept:
             res = super()._l10n_mx_edi_export_invoice_cfdi(invoice)
             return res
-        # override
-        # == CFDI values ==
-        cfdi_values = self._l10n_mx_edi_get_invoice_cfdi_values(invoice)
-        qweb_template, xsd_attachment = self._l10n_mx_edi_get_invoice_templates_global()
+        # The same CFDI has already been sealed, e.g. the PAC rejected or timed out on a previous attempt.
+        cache_keys = self._context.get('l10n_mx_edi_global_cfdi_cache_keys') or {}
+        cache_key = cache_keys.get(invoice.id) or self._l10n_mx_edi_get_global_cfdi_cache_key(invoice)
+        res = self._l10n_mx_edi_get_global_cfdi_cache(invoice, cache_key)
+        if res:
+            return res
 
-        # == Generate the CFDI ==
-        cfdi = qweb_template._render(cfdi_values)
-        decoded_cfdi_values = invoice._l10n_mx_edi_decode_cfdi(cfdi_data=cfdi)
-        cfdi_cadena_crypted = cfdi_values['certificate'].sudo().get_encrypted_cadena(decoded_cfdi_values['cadena'])
-        decoded_cfdi_values['cfdi_node'].attrib['Sello'] = cfdi_cadena_crypted
+        res = self._l10n_mx_edi_export_global_cfdi(invoice, cache_key)
+        if not res.get('errors'):
+            invoice.sudo().write({
+                'global_cfdi_cache_key': cache_key,
+                'global_cfdi_cache_file': base64.b64encode(res['cfdi_str']),
+            })
+        return res
 
-        # == Optional check using the XSD ==
-        xsd_datas = base64.b64decode(xsd_attachment.datas) if xsd_attachment else None
+    def _l10n_mx_edi_export_global_cfdi(self, invoice, cache_key):
+        # Already exported by '_l10n_mx_edi_export_global_cfdi_batch'.
+        batch_results = self._context.get('l10n_mx_edi_global_cfdi_batch_results') or {}
+        if invoice.id in batch_results:
+            return batch_results[invoice.id]
+        # Already exported in background by 'account.global.export.job'.
+        job = self.env['account.global.export.job'].search([
+            ('move_id', '=', invoice.id), ('edi_format_id', '=', self.id), ('state', '=', 'done'),
+        ], limit=1)
+        if job and job.fingerprint == cache_key:
+            return job._get_export_result()
 
-        res = {
-            'cfdi_str': etree.tostring(decoded_cfdi_values['cfdi_node'], pretty_print=True, xml_declaration=True, encoding='UTF-8'),
-        }
+        metric_model = self.env['account.global.export.metric']
+        profiler = metric_model._get_global_export_profiler(invoice)
+        edi_format = self.with_context(l10n_mx_edi_global_profiler=profiler)
 
-        if xsd_datas:
-            try:
-                with BytesIO(xsd_datas) as xsd:
-                    _check_with_xsd(decoded_cfdi_values['cfdi_node'], xsd)
-            except (IOError, ValueError):
-                _logger.info(_('The xsd file to validate the XML structure was not found'))
-            except Exception as e:
-                res['errors'] = str(e).split('\\n')
+        with profiler.stage('total'):
+            # == CFDI values ==
+            cfdi_values = edi_format._l10n_mx_edi_get_invoice_cfdi_values(invoice)
+            xsd_attachment = self._l10n_mx_edi_get_invoice_templates_global()[1]
 
+            # == Generate the CFDI ==
+            with profiler.stage('render'):
+                cfdi_node = self._l10n_mx_edi_render_global_cfdi(cfdi_values)
+            res = _seal_global_cfdi_node(
+                cfdi_node,
+                cfdi_values['certificate'].sudo().get_encrypted_cadena,
+                self._l10n_mx_edi_get_cadena_xslts()[1],
+                xsd_checksum=xsd_attachment.checksum if xsd_attachment else None,
+                get_xsd_datas=lambda: base64.b64decode(xsd_attachment.datas),
+                profiler=profiler,
+            )
+        metric_model._save_global_export_profiler(profiler)
         return res
+
+    def _l10n_mx_edi_dry_run_global_cfdi(self, invoice):
+        ''' Check the global CFDI of 'invoice' as '_l10n_mx_edi_export_invoice_cfdi' would: configuration, rendering,
+        totals and tax summary of the rendered CFDI, cadena and XSD, but without sealing it, see
+        'account.move._dry_run_global_cfdi' and '_get_global_cfdi_totals'.
+
+        :return: A python dict reporting the checks of the invoice.
+        '''
+        report = {
+            'move_id': invoice.id,
+            'name': invoice.name,
+            'line_count': 0,
+            'concept_count': 0,
+            'amount_total': invoice.amount_total,
+            'amount_total_concept': invoice.amount_total_concept,
+            'amount_total_cfdi': None,
+            'tax_totals': {},
+            'xml_size': 0,
+            'durations': {},
+            'errors': [],
+        }
+        if not invoice.is_global_concept:
+            report['errors'].append("La factura no es de concepto global")
+            return report
+        report['errors'] += self._l10n_mx_edi_check_configuration(invoice)
+        if report['errors']:
+            return report
+
+        currency = invoice.currency_id
+        if currency.compare_amounts(invoice.amount_total, invoice.amount_total_concept):
+            report['errors'].append(f"El monto global total {invoice.amount_total_concept} deber ser igual al monto de la factura: {invoice.amount_total}")
+
+        profiler = GlobalExportProfiler(invoice.id, invoice.global_line_count)
+        edi_format = self.with_context(l10n_mx_edi_global_profiler=profiler)
+        try:
+            # A database error only aborts the checks of this invoice, not the ones of the next invoices.
+            with self.env.cr.savepoint():
+                cfdi_values = edi_format._l10n_mx_edi_get_invoice_cfdi_values(invoice)
+                line_vals_table = cfdi_values['invoice_line_vals_list']
+                report['line_count'] = len(line_vals_table.line_ids)
+                report['concept_count'] = len(line_vals_table)
+
+                xsd_attachment = self._l10n_mx_edi_get_invoice_templates_global()[1]
+                with profiler.stage('render'):
+                    cfdi_node = self._l10n_mx_edi_render_global_cfdi(cfdi_values)
+
+                # The totals are checked on the rendered CFDI, as written for the SAT.
+                with profiler.stage('totals'):
+                    totals, errors = _get_global_cfdi_totals(cfdi_node)
+                report['errors'] += errors
+                report['tax_totals'] = {tax_type: float(totals[tax_type]) for tax_type in ('transferred', 'withholding')}
+                report['amount_total_cfdi'] = float(totals['total'])
+                if currency.compare_amounts(report['amount_total_cfdi'], invoice.amount_total):
+                    report['errors'].append(f"El Total del CFDI {report['amount_total_cfdi']} no coincide con el monto de la factura: {invoice.amount_total}")
+
+                res = _seal_global_cfdi_node(
+                    cfdi_node,
+                    lambda cadena: '',
+                    self._l10n_mx_edi_get_cadena_xslts()[1],
+                    xsd_checksum=xsd_attachment.checksum if xsd_attachment else None,
+                    get_xsd_datas=lambda: base64.b64decode(xsd_attachment.datas),
+                    profiler=profiler,
+                )
+                report['errors'] += res.get('errors', [])
+                report['xml_size'] = profiler.xml_size
+        except Exception as e:
+            report['errors'].append(str(e))
+        report['durations'] = {stage['stage']: stage['duration'] for stage in profiler.stages}
+        return report
+
+    def _l10n_mx_edi_get_global_export_workers(self):
+        ''' The number of processes sealing the global CFDIs of a batch, see '_l10n_mx_edi_export_global_cfdi_batch'.
+        Forking is only safe from the single threaded workers of a prefork server: the threaded server and the
+        development server seal the CFDIs serially.
+        '''
+        if not config['workers']:
+            return 1
+        workers = self.env['ir.config_parameter'].sudo().get_param('global_concepts.export_workers', '2')
+        return max(int(workers), 1)
+
+    def _l10n_mx_edi_export_global_cfdi_batch(self, invoices):
+        ''' Export many global invoices at once. The CFDI values are computed and rendered here, with the ORM, then
+        the cadena, the sealing, the serialization and the XSD validation are done by a small pool of processes, or
+        serially, see '_l10n_mx_edi_get_global_export_workers'.
+
+        :param invoices:    The global concept invoices to export.
+        :return: A dict mapping the invoice ids to the results of '_l10n_mx_edi_export_invoice_cfdi'.
+        '''
+        xsd_attachment = self._l10n_mx_edi_get_invoice_templates_global()[1]
+        xsd_checksum = xsd_attachment.checksum if xsd_attachment else None
+        cadena_xslt_path = self._l10n_mx_edi_get_cadena_xslts()[1]
+
+        metric_model = self.env['account.global.export.metric']
+        payloads = []
+        for invoice in invoices:
+            profiler = metric_model._get_global_export_profiler(invoice)
+            edi_format = self.with_context(l10n_mx_edi_global_profiler=profiler)
+            cfdi_values = edi_format._l10n_mx_edi_get_invoice_cfdi_values(invoice)
+            certificate = cfdi_values['certificate'].sudo()
+            with profiler.stage('render'):
+                cfdi_node = self._l10n_mx_edi_render_global_cfdi(cfdi_values)
+            metric_model._save_global_export_profiler(profiler)
+            payloads.append({
+                'cfdi': etree.tostring(cfdi_node, encoding='UTF-8'),
+                'key_pem': certificate.get_pem_key(certificate.key, certificate.password),
+                'cadena_xslt_path': cadena_xslt_path,
+                'xsd_checksum': xsd_checksum,
+            })
+
+        workers = min(self._l10n_mx_edi_get_global_export_workers(), len(payloads))
+        if workers <= 1:
+            _init_global_cfdi_worker(xsd_checksum, xsd_checksum and base64.b64decode(xsd_attachment.datas))
+            results = [_seal_global_cfdi(payload) for payload in payloads]
+        else:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_global_cfdi_worker,
+                initargs=(xsd_checksum, xsd_checksum and base64.b64decode(xsd_attachment.datas)),
+            ) as executor:
+                results = list(executor.map(_seal_global_cfdi, payloads))
+        return dict(zip(invoices.ids, results))
+
+    def _support_batching(self, move=None, state=None, company=None):
+        # OVERRIDE
+        if self.code == 'cfdi_3_3' and state == 'to_send' and move and move.is_global_concept:
+            return True
+        return super()._support_batching(move=move, state=state, company=company)
+
+    def _get_batch_key(self, move, state):
+        # OVERRIDE
+        # Keep the global invoices together so they are exported by '_l10n_mx_edi_export_global_cfdi_batch'.
+        if self.code == 'cfdi_3_3' and move.is_global_concept:
+            return super()._get_batch_key(move, state) + ('global_concept',)
+        return super()._get_batch_key(move, state)
+
+    def _post_invoice_edi(self, invoices):
+        # OVERRIDE
+        if self.code != 'cfdi_3_3':
+            return super()._post_invoice_edi(invoices)
+        global_invoices = invoices.filtered(
+            lambda invoice: invoice.is_global_concept and not self._l10n_mx_edi_check_configuration(invoice))
+
+        # Large global invoices are exported in background, don't send them until their job is done.
+        # The jobs are only readable by the users, they are managed on their behalf.
+        job_model = self.env['account.global.export.job'].sudo()
+        async_invoices = job_model._get_async_invoices(global_invoices)
+        cache_keys = {invoice: self._l10n_mx_edi_get_global_cfdi_cache_key(invoice) for invoice in global_invoices}
+        cached_invoices = global_invoices.filtered(
+            lambda invoice: self._l10n_mx_edi_has_global_cfdi_cache(invoice, cache_keys[invoice]))
+        async_invoices -= cached_invoices
+        queued_results = job_model._get_post_results(self, async_invoices, cache_keys=cache_keys)
+        queued_invoices = invoices.browse([invoice.id for invoice in queued_results])
+        invoices -= queued_invoices
+        sent_global_invoices = global_invoices - queued_invoices
+        global_invoices -= async_invoices | cached_invoices
+
+        edi_format = self.with_context(l10n_mx_edi_global_cfdi_cache_keys={
+            invoice.id: cache_key for invoice, cache_key in cache_keys.items()})
+        if len(global_invoices) >= 2:
+            batch_results = self._l10n_mx_edi_export_global_cfdi_batch(global_invoices)
+            edi_format = edi_format.with_context(l10n_mx_edi_global_cfdi_batch_results=batch_results)
+        edi_result = super(AccountEdiFormat, edi_format)._post_invoice_edi(invoices) if invoices else {}
+
+        # The CFDI of the background jobs and the cached CFDI have been sent, they are not needed anymore.
+        sent_invoices = sent_global_invoices.filtered(lambda invoice: not edi_result.get(invoice, {}).get('error'))
+        if sent_invoices:
+            job_model.search([('move_id', 'in', sent_invoices.ids), ('edi_format_id', '=', self.id)]).unlink()
+            sent_invoices.sudo().write({'global_cfdi_cache_key': False, 'global_cfdi_cache_file': False})
+
+        edi_result.update(queued_results)
+        return edi_result
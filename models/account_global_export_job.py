@@ -0,0 +1,179 @@
+from odoo import api, models, fields, _
+
+import base64
+import logging
+
+from lxml import etree
+
+from .account_edi_format import _seal_global_cfdi_node
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountGlobalExportJob(models.Model):
+    _name = "account.global.export.job"
+    _description = "Global CFDI Export Job"
+    _order = "id"
+
+    move_id = fields.Many2one('account.move', string='Journal Entry', required=True, index=True, ondelete="cascade")
+    edi_format_id = fields.Many2one('account.edi.format', required=True, ondelete="cascade")
+    certificate_id = fields.Many2one('l10n_mx_edi.certificate', ondelete="set null")
+    state = fields.Selection(selection=[
+        ('pending', 'Pendiente'),
+        ('done', 'Terminado'),
+        ('failed', 'Error'),
+    ], string='Estado', default='pending', required=True)
+    stage = fields.Selection(selection=[
+        ('render', 'Generacion'),
+        ('seal', 'Sellado y validacion'),
+        ('done', 'Terminado'),
+    ], string='Etapa', default='render', required=True)
+    progress = fields.Integer(string='Progreso (%)', default=0)
+    fingerprint = fields.Char(help="Cache key of the invoice the job was computed from, see "
+                                   "'account.edi.format._l10n_mx_edi_get_global_cfdi_cache_key'.")
+    unsigned_cfdi = fields.Binary(attachment=True, help="Result of the 'render' stage.")
+    cfdi_file = fields.Binary(attachment=True, help="Result of the 'seal' stage.")
+    error = fields.Text()
+    error_reported = fields.Boolean()
+
+    @api.model
+    def _get_async_threshold(self):
+        threshold = self.env['ir.config_parameter'].sudo().get_param('global_concepts.async_export_threshold', '5000')
+        return int(threshold or 0)
+
+    @api.model
+    def _get_async_invoices(self, invoices):
+        ''' Return the global invoices having more global lines than the 'global_concepts.async_export_threshold'
+        system parameter. Their CFDI is exported in background, 0 disables it.
+        '''
+        threshold = self._get_async_threshold()
+        global_invoices = invoices.filtered('is_global_concept')
+        if not threshold or not global_invoices:
+            return invoices.browse()
+        groups = self.env['account.global.line'].read_group(
+            [('move_id', 'in', global_invoices.ids)], ['move_id'], ['move_id'])
+        move_ids = {group['move_id'][0] for group in groups if group['move_id_count'] > threshold}
+        return global_invoices.filtered(lambda invoice: invoice.id in move_ids)
+
+    @api.model
+    def _get_fingerprint(self, edi_format, invoice):
+        ''' What the CFDI of 'invoice' depends on, a job computed for another fingerprint is restarted. '''
+        return edi_format._l10n_mx_edi_get_global_cfdi_cache_key(invoice)
+
+    @api.model
+    def _get_post_results(self, edi_format, invoices, cache_keys=None):
+        ''' Queue the background export of 'invoices' when needed.
+
+        :param cache_keys:  The keys of '_l10n_mx_edi_get_global_cfdi_cache_key' already computed by invoice.
+        :return: A dict with the '_post_invoice_edi' results of the invoices whose job is not done yet.
+        '''
+        jobs = self.search([('move_id', 'in', invoices.ids), ('edi_format_id', '=', edi_format.id)])
+        job_by_move = {job.move_id: job for job in jobs}
+        results = {}
+        to_trigger = False
+        for invoice in invoices:
+            job = job_by_move.get(invoice)
+            fingerprint = (cache_keys or {}).get(invoice) or self._get_fingerprint(edi_format, invoice)
+            if not job:
+                job = self.create({'move_id': invoice.id, 'edi_format_id': edi_format.id, 'fingerprint': fingerprint})
+            elif job.fingerprint != fingerprint:
+                job._restart(fingerprint)
+            elif job.state == 'done':
+                continue
+            elif job.state == 'failed':
+                if not job.error_reported:
+                    job.error_reported = True
+                    results[invoice] = {
+                        'error': edi_format._l10n_mx_edi_format_error_message(
+                            _("Failure during the generation of the CFDI:"), [job.error]),
+                        'blocking_level': 'error',
+                    }
+                    continue
+                # The error has already been reported, the user is retrying.
+                job.write({'state': 'pending', 'error': False, 'error_reported': False})
+
+            to_trigger = True
+            results[invoice] = {
+                'error': _("The CFDI is being generated in background (%s, %s%%).",
+                           dict(job._fields['stage'].selection)[job.stage], job.progress),
+                'blocking_level': 'info',
+            }
+        if to_trigger:
+            self.env.ref('global_concepts.ir_cron_global_export_job')._trigger()
+        return results
+
+    def _restart(self, fingerprint):
+        self.write({
+            'state': 'pending',
+            'stage': 'render',
+            'progress': 0,
+            'fingerprint': fingerprint,
+            'unsigned_cfdi': False,
+            'cfdi_file': False,
+            'error': False,
+            'error_reported': False,
+        })
+
+    def _get_export_result(self):
+        ''' Return the result of the job as '_l10n_mx_edi_export_invoice_cfdi'. '''
+        self.ensure_one()
+        res = {'cfdi_str': base64.b64decode(self.with_context(bin_size=False).cfdi_file)}
+        if self.error:
+            res['errors'] = self.error.split('\n')
+        return res
+
+    def _run_stage_render(self):
+        edi_format = self.edi_format_id
+        cfdi_values = edi_format._l10n_mx_edi_get_invoice_cfdi_values(self.move_id)
+        cfdi_node = edi_format._l10n_mx_edi_render_global_cfdi(cfdi_values)
+        self.write({
+            'certificate_id': cfdi_values['certificate'].id,
+            'unsigned_cfdi': base64.b64encode(etree.tostring(cfdi_node, encoding='UTF-8')),
+            'stage': 'seal',
+            'progress': 50,
+        })
+
+    def _run_stage_seal(self):
+        xsd_attachment = self.edi_format_id._l10n_mx_edi_get_invoice_templates_global()[1]
+        cfdi_node = etree.fromstring(
+            base64.b64decode(self.with_context(bin_size=False).unsigned_cfdi),
+            etree.XMLParser(remove_blank_text=True, huge_tree=True),
+        )
+        res = _seal_global_cfdi_node(
+            cfdi_node,
+            self.certificate_id.sudo().get_encrypted_cadena,
+            self.edi_format_id._l10n_mx_edi_get_cadena_xslts()[1],
+            xsd_checksum=xsd_attachment.checksum if xsd_attachment else None,
+            get_xsd_datas=lambda: base64.b64decode(xsd_attachment.datas),
+        )
+        self.write({
+            'cfdi_file': base64.b64encode(res['cfdi_str']),
+            'error': '\n'.join(res['errors']) if res.get('errors') else False,
+            'unsigned_cfdi': False,
+            'state': 'done',
+            'stage': 'done',
+            'progress': 100,
+        })
+
+    def _run(self, with_commit=True):
+        ''' Run the remaining stages of the jobs. Each stage is committed so an interrupted job resumes from the last
+        completed one.
+        '''
+        for job in self:
+            while job.state == 'pending':
+                try:
+                    with self.env.cr.savepoint():
+                        getattr(job, '_run_stage_%s' % job.stage)()
+                except Exception as e:
+                    _logger.exception("Global CFDI export job %s failed at stage %s", job.id, job.stage)
+                    job.write({'state': 'failed', 'error': str(e)})
+                if with_commit:
+                    self.env.cr.commit()
+            if job.state != 'pending':
+                # Let the EDI flow send the generated CFDI.
+                self.env.ref('account_edi.ir_cron_edi_network')._trigger()
+
+    @api.model
+    def _cron_process_jobs(self, job_count=None):
+        jobs = self.search([('state', '=', 'pending')], limit=job_count)
+        jobs._run()
@@ -0,0 +1,110 @@
+from odoo import api, models, fields
+
+import json
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+_logger = logging.getLogger(__name__)
+
+
+class GlobalExportProfiler:
+    ''' Collect the duration and, optionally, the peak of allocated memory of each stage of the export of a global
+    CFDI. See '_get_global_export_profiler' on 'account.global.export.metric'.
+    '''
+
+    def __init__(self, move_id, line_count, store=False, trace_memory=False):
+        self.move_id = move_id
+        self.line_count = line_count
+        self.xml_size = 0
+        self.store = store
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        nested_index = len(self.stages)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            duration = (time.perf_counter() - start) * 1000.0
+            memory_peak = 0
+            if self.trace_memory:
+                # The nested stages reset the peak, take theirs into account.
+                memory_peak = max([tracemalloc.get_traced_memory()[1] // 1024]
+                                  + [stage['memory_peak'] for stage in self.stages[nested_index:]])
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages.append({'stage': name, 'duration': duration, 'memory_peak': memory_peak})
+
+    def get_records(self):
+        return [{
+            'move_id': self.move_id,
+            'line_count': self.line_count,
+            'xml_size': self.xml_size,
+            **stage,
+        } for stage in self.stages]
+
+
+class NullGlobalExportProfiler:
+    ''' Profiler used when the metrics are disabled, all its methods do nothing. '''
+
+    stages = []
+    xml_size = 0
+
+    def stage(self, name):
+        return nullcontext(self)
+
+    def get_records(self):
+        return []
+
+
+NULL_PROFILER = NullGlobalExportProfiler()
+
+
+class AccountGlobalExportMetric(models.Model):
+    _name = "account.global.export.metric"
+    _description = "Global CFDI Export Metric"
+    _order = "id desc"
+
+    move_id = fields.Many2one('account.move', string='Journal Entry', index=True, ondelete="cascade")
+    stage = fields.Char(string='Stage', required=True)
+    duration = fields.Float(string='Duration (ms)')
+    memory_peak = fields.Integer(string='Memory Peak (KiB)')
+    line_count = fields.Integer(string='Global Lines')
+    xml_size = fields.Integer(string='XML Size (bytes)')
+
+    @api.model
+    def _get_global_export_profiler(self, move):
+        ''' Return the profiler of the export of 'move' depending on the 'global_concepts.export_metrics' system
+        parameter: empty to disable the metrics, 'log' to log them or 'store' to also store them in this model.
+        The peak of allocated memory is traced only when 'global_concepts.export_metrics_memory' is set.
+        '''
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        mode = get_param('global_concepts.export_metrics')
+        if not mode or self._context.get('global_export_metrics_disabled'):
+            return NULL_PROFILER
+        return GlobalExportProfiler(
+            move.id,
+            len(move.global_lines),
+            store=mode == 'store',
+            trace_memory=bool(get_param('global_concepts.export_metrics_memory')),
+        )
+
+    @api.model
+    def _save_global_export_profiler(self, profiler):
+        records = profiler.get_records()
+        if not records:
+            return
+        _logger.info("Global CFDI export metrics: %s", json.dumps(records))
+        if profiler.store:
+            self.sudo().create(records)
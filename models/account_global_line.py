@@ -1,4 +1,8 @@
-from odoo import api, models, fields
+from odoo import api, models, fields, tools
+from collections import defaultdict
+
+from .global_edi_values import GlobalLineEdiTable
+from . import global_tax_engine
 
 
 class AccountGlobaLine(models.Model):
@@ -9,7 +13,8 @@ class AccountGlobaLine(models.Model):
                               index=True, readonly=True, auto_join=True, ondelete="cascade",
                               check_company=True,
                               help="The move of this entry line.")
-    company_id = fields.Many2one(related='move_id.company_id', store=True, readonly=True, )
+    company_id = fields.Many2one(related='move_id.company_id', store=True, readonly=True, index=True, )
+    date = fields.Date(related='move_id.date', store=True, readonly=True, )
     product_id = fields.Many2one('product.product', string='Product', ondelete='restrict')
     quantity = fields.Float(string='Quantity',
                             default=1.0,
@@ -19,7 +24,7 @@ class AccountGlobaLine(models.Model):
 
     product_uom_id = fields.Many2one('uom.uom', string='Unit of Measure',
                                      domain="[('category_id', '=', product_uom_category_id)]", ondelete="restrict")
-    product_uom_category_id = fields.Many2one('uom.category', related='product_id.uom_id.category_id')
+    product_uom_category_id = fields.Many2one('uom.category', related='product_id.uom_id.category_id', store=True)
     price_unit = fields.Float(string='Unit Price', digits='Product Price')
 
     price_subtotal = fields.Monetary(string='Subtotal', store=True, readonly=True,
@@ -32,7 +37,7 @@ class AccountGlobaLine(models.Model):
         context={'active_test': False},
         check_company=True,
         help="Taxes that apply on the base amount")
-    currency_id = fields.Many2one('res.currency', string='Currency', related="move_id.currency_id")
+    currency_id = fields.Many2one('res.currency', string='Currency', related="move_id.currency_id", store=True)
     discount = fields.Float(string='Discount (%)', digits='Discount', default=0.0)
     name = fields.Char(string='Label', related="product_id.display_name", store=True, readonly=False)
     l10n_mx_edi_customs_number = fields.Char(
@@ -69,14 +74,32 @@ class AccountGlobaLine(models.Model):
         help="Unit value expressed in the UMT from product. It is used in the attribute 'ValorUnitarioAduana' in the "
              "CFDI")
 
+    def init(self):
+        super().init()
+        # Lines of an invoice by product, used by the summaries and the consolidation of the concepts.
+        tools.create_index(self._cr, 'account_global_line_move_product_index', self._table, ['move_id', 'product_id'])
+        tools.create_index(self._cr, 'account_global_line_company_date_index', self._table, ['company_id', 'date'])
+
     @api.depends('l10n_mx_edi_umt_aduana_id', 'product_uom_id', 'quantity')
     def _compute_l10n_mx_edi_qty_umt(self):
+        # The conversion only depends on the aduana codes of the UMT and of the unit of measure, resolve it once per
+        # couple of units.
+        conversions = {}
         for line in self:
-            product_aduana_code = line.l10n_mx_edi_umt_aduana_id.l10n_mx_edi_code_aduana
-            uom_aduana_code = line.product_uom_id.l10n_mx_edi_code_aduana
-            if product_aduana_code == uom_aduana_code:
+            uom_key = (line.l10n_mx_edi_umt_aduana_id, line.product_uom_id)
+            if uom_key not in conversions:
+                product_aduana_code = line.l10n_mx_edi_umt_aduana_id.l10n_mx_edi_code_aduana
+                uom_aduana_code = line.product_uom_id.l10n_mx_edi_code_aduana
+                if product_aduana_code == uom_aduana_code:
+                    conversions[uom_key] = 'quantity'
+                elif '01' in (product_aduana_code or ''):
+                    conversions[uom_key] = 'weight'
+                else:
+                    conversions[uom_key] = None
+
+            if conversions[uom_key] == 'quantity':
                 line.l10n_mx_edi_qty_umt = line.quantity
-            elif '01' in (product_aduana_code or ''):
+            elif conversions[uom_key] == 'weight':
                 line.l10n_mx_edi_qty_umt = line.product_id.weight * line.quantity
             else:
                 line.l10n_mx_edi_qty_umt = None
@@ -91,18 +114,121 @@ class AccountGlobaLine(models.Model):
 
     @api.onchange('product_id')
     def _onchange_product_id(self):
-        for line in self:
-            if not line.product_id:
+        #line.name = line._get_computed_name()
+        #line.account_id = line._get_computed_account()
+        for line, vals in self._get_product_defaults().items():
+            line.update(vals)
+
+    def _get_product_defaults(self):
+        ''' Compute the taxes, unit of measure and unit price the product sets on each line, see
+        '_get_product_default_vals'. The products are prefetched at once.
+
+        :return: A dict mapping each line having a product to the values to update it with.
+        '''
+        lines = self.filtered('product_id')
+        products = lines.product_id
+        products.mapped('taxes_id')
+        products.mapped('supplier_taxes_id')
+        products.mapped('uom_id')
+        products.mapped('uom_po_id')
+
+        caches = defaultdict(dict)
+        return {
+            line: self._get_product_default_vals(line.product_id, line.move_id, caches, line=line)
+            for line in lines
+        }
+
+    @api.model
+    def _prepare_product_default_vals(self, vals_list):
+        ''' Server-side counterpart of '_onchange_product_id' for the lines to create, e.g. when importing them: the
+        taxes, unit of measure and unit price missing from the values of a line having a product are set from it.
+
+        :param vals_list: The values passed to 'create', updated in place.
+        '''
+        default_move_id = self._context.get('default_move_id')
+        products = self.env['product.product'].browse({vals['product_id'] for vals in vals_list if vals.get('product_id')})
+        caches = defaultdict(dict)
+        for vals in vals_list:
+            missing_fields = {
+                fname for fname in ('tax_ids', 'product_uom_id', 'price_unit')
+                if fname not in vals and 'default_%s' % fname not in self._context
+            }
+            move = self.env['account.move'].browse(vals.get('move_id') or default_move_id)
+            if not vals.get('product_id') or not missing_fields or not move:
                 continue
 
-            #line.name = line._get_computed_name()
-            #line.account_id = line._get_computed_account()
-            taxes = line._get_computed_taxes()
-            if taxes and line.move_id.fiscal_position_id:
-                taxes = line.move_id.fiscal_position_id.map_tax(taxes)
-            line.tax_ids = taxes
-            line.product_uom_id = line._get_computed_uom()
-            line.price_unit = line._get_computed_price_unit()
+            product = products.browse(vals['product_id']).with_prefetch(products._prefetch_ids)
+            product_uom = self.env['uom.uom'].browse(vals.get('product_uom_id'))
+            default_vals = self._get_product_default_vals(product, move, caches, product_uom=product_uom)
+            if 'tax_ids' in missing_fields:
+                vals['tax_ids'] = [(6, 0, default_vals['tax_ids'].ids)]
+            if 'product_uom_id' in missing_fields:
+                vals['product_uom_id'] = default_vals['product_uom_id'].id
+            if 'price_unit' in missing_fields:
+                vals['price_unit'] = default_vals['price_unit']
+
+    @api.model
+    def _get_product_default_vals(self, product, move, caches, product_uom=None, line=None):
+        ''' Compute the taxes, unit of measure and unit price 'product' sets on a line of 'move', see
+        '_get_computed_taxes', '_get_computed_uom' and '_get_computed_price_unit'.
+        The values are memoized in 'caches' per product, fiscal position, company, document type, currency, date and
+        unit of measure, so the lines sharing them are resolved only once.
+
+        :param product:     The product of the line.
+        :param move:        The invoice of the line.
+        :param caches:      A defaultdict(dict) shared by the lines resolved together.
+        :param product_uom: The unit of measure of the line, the default one of the product if not set.
+        :param line:        The line itself if it exists, a new line is used otherwise.
+        :return: A python dict with the 'tax_ids', 'product_uom_id' and 'price_unit'.
+        '''
+        document_type = self._get_document_type(move)
+        fiscal_position = move.fiscal_position_id
+
+        def get_line():
+            return line or self.new({'move_id': move, 'product_id': product})
+
+        taxes_key = (product, fiscal_position, move.company_id, document_type)
+        taxes_cache = caches['taxes']
+        if taxes_key not in taxes_cache:
+            taxes = get_line()._get_computed_taxes()
+            if taxes and fiscal_position:
+                taxes = fiscal_position.map_tax(taxes)
+            taxes_cache[taxes_key] = taxes
+
+        if not product_uom:
+            uom_key = (product, move.is_purchase_document())
+            uom_cache = caches['uom']
+            if uom_key not in uom_cache:
+                uom_cache[uom_key] = get_line()._get_computed_uom()
+            product_uom = uom_cache[uom_key]
+
+        price_unit_key = (product, fiscal_position, move.company_id, document_type, move.currency_id, move.date,
+                          product_uom)
+        price_unit_cache = caches['price_unit']
+        if price_unit_key not in price_unit_cache:
+            price_unit_cache[price_unit_key] = product._get_tax_included_unit_price(
+                move.company_id,
+                move.currency_id,
+                move.date,
+                document_type,
+                fiscal_position=fiscal_position,
+                product_uom=product_uom
+            )
+
+        return {
+            'tax_ids': taxes_cache[taxes_key],
+            'product_uom_id': product_uom,
+            'price_unit': price_unit_cache[price_unit_key],
+        }
+
+    @api.model
+    def _get_document_type(self, move):
+        if move.is_sale_document(include_receipts=True):
+            return 'sale'
+        elif move.is_purchase_document(include_receipts=True):
+            return 'purchase'
+        else:
+            return 'other'
 
     def _get_computed_taxes(self):
         self.ensure_one()
@@ -139,23 +265,197 @@ class AccountGlobaLine(models.Model):
 
         if not self.product_id:
             return 0.0
-        if self.move_id.is_sale_document(include_receipts=True):
-            document_type = 'sale'
-        elif self.move_id.is_purchase_document(include_receipts=True):
-            document_type = 'purchase'
-        else:
-            document_type = 'other'
 
         return self.product_id._get_tax_included_unit_price(
             self.move_id.company_id,
             self.move_id.currency_id,
             self.move_id.date,
-            document_type,
+            self._get_document_type(self.move_id),
             fiscal_position=self.move_id.fiscal_position_id,
             product_uom=self.product_uom_id
         )
 
-    @api.onchange('quantity', 'price_unit', 'tax_ids')
+    @api.model_create_multi
+    def create(self, vals_list):
+        self._prepare_product_default_vals(vals_list)
+        priced = self._prepare_price_subtotal_vals(vals_list)
+        lines = super().create(vals_list)
+        # Lines created without invoice in their values get their amounts once linked to it.
+        lines.browse([line.id for line, is_priced in zip(lines, priced) if not is_priced])._compute_price_subtotal_batch()
+        return lines
+
+    def write(self, vals):
+        if 'move_id' in vals:
+            price_invoice_keys = {line.id: line._get_price_invoice_key() for line in self}
+        res = super().write(vals)
+        trigger_fields = self._get_price_subtotal_trigger_fields().intersection(vals)
+        if trigger_fields - {'move_id'}:
+            self._compute_price_subtotal_batch()
+        elif trigger_fields:
+            # Moving lines to another invoice only changes their amounts if it is priced differently.
+            self.filtered(
+                lambda line: line._get_price_invoice_key() != price_invoice_keys[line.id]
+            )._compute_price_subtotal_batch()
+        return res
+
+    @api.model
+    def _get_price_subtotal_trigger_fields(self):
+        return {'quantity', 'price_unit', 'discount', 'tax_ids', 'move_id'}
+
+    def _get_price_invoice_key(self):
+        ''' The values of the invoice the amounts of the line depend on, see '_compute_price_amounts_batch'. '''
+        self.ensure_one()
+        move = self.move_id
+        return move.currency_id, move.move_type, move.partner_id, move.company_id
+
+    @api.model
+    def _prepare_price_subtotal_vals(self, vals_list):
+        ''' Set 'price_subtotal' and 'price_total' in the values of the lines to create, so they are inserted with their
+        amounts instead of being written a second time.
+
+        :param vals_list: The values passed to 'create', updated in place.
+        :return: A list of booleans telling, for each values, if the invoice was known and the amounts set.
+        '''
+        default_move_id = self._context.get('default_move_id')
+        taxes_by_commands = {}
+        entries = []
+        indexes = []
+        priced = []
+        for index, vals in enumerate(vals_list):
+            move = self.env['account.move'].browse(vals.get('move_id') or default_move_id)
+            priced.append(bool(move))
+            if not move or not move.is_invoice(include_receipts=True):
+                continue
+
+            tax_commands = vals.get('tax_ids') or []
+            commands_key = repr(tax_commands)
+            if commands_key not in taxes_by_commands:
+                taxes_by_commands[commands_key] = self.new({'tax_ids': tax_commands}).tax_ids._origin
+            entries.append({
+                'move': move,
+                'taxes': taxes_by_commands[commands_key],
+                'product': self.env['product.product'].browse(vals.get('product_id')),
+                'price_unit': vals.get('price_unit', 0.0),
+                'quantity': vals.get('quantity', 1.0),
+                'discount': vals.get('discount', 0.0),
+            })
+            indexes.append(index)
+
+        for index, (price_subtotal, price_total) in zip(indexes, self._compute_price_amounts_batch(entries)):
+            vals_list[index].update({'price_subtotal': price_subtotal, 'price_total': price_total})
+        return priced
+
+    def _compute_price_subtotal_batch(self):
+        ''' Server-side counterpart of '_onchange_price_subtotal' for a whole recordset. The results are written with
+        one query per distinct (price_subtotal, price_total) couple, only for the lines whose amounts changed.
+        '''
+        lines = self.filtered(lambda line: line.move_id.is_invoice(include_receipts=True))
+        entries = [{
+            'move': line.move_id,
+            'taxes': line.tax_ids,
+            'product': line.product_id,
+            'price_unit': line.price_unit,
+            'quantity': line.quantity,
+            'discount': line.discount,
+        } for line in lines]
+
+        line_ids_by_result = defaultdict(list)
+        for line, amounts in zip(lines, self._compute_price_amounts_batch(entries)):
+            if amounts != (line.price_subtotal, line.price_total):
+                line_ids_by_result[amounts].append(line.id)
+
+        for (price_subtotal, price_total), line_ids in line_ids_by_result.items():
+            self.browse(line_ids).write({'price_subtotal': price_subtotal, 'price_total': price_total})
+
+    @api.model
+    def _compute_price_amounts_batch(self, entries):
+        ''' Compute the amounts of '_get_price_total_and_subtotal_model' for many lines at once.
+        The lines are grouped by taxes, currency and type of invoice. When the taxes of a group are plain percentages, see
+        '_get_price_tax_rates', the amounts are computed arithmetically like 'compute_all' does. The other groups fall back
+        on 'compute_all', called once per distinct line.
+
+        :param entries: A list of python dicts with the 'move', 'taxes', 'product', 'price_unit', 'quantity' and
+                        'discount' of each line.
+        :return: A list of (price_subtotal, price_total) tuples, in the order of the entries.
+        '''
+        groups = {}
+        computed = {}
+        res = []
+        for entry in entries:
+            move = entry['move']
+            taxes = entry['taxes']
+            group_key = (taxes, move.currency_id, move.move_type)
+            if group_key not in groups:
+                groups[group_key] = {
+                    'rates': self._get_price_tax_rates(taxes, move),
+                    # Only python taxes may use the product, other taxes give the same result for any product.
+                    'product_dependent': 'code' in taxes.mapped('amount_type'),
+                }
+            group = groups[group_key]
+
+            if group['rates'] is not None:
+                res.append(self._get_price_amounts_by_rates(
+                    entry['price_unit'], entry['quantity'], entry['discount'], move.currency_id, group['rates']))
+                continue
+
+            key = (
+                group_key,
+                move.partner_id,
+                entry['product'] if group['product_dependent'] else None,
+                entry['price_unit'],
+                entry['quantity'],
+                entry['discount'],
+            )
+            if key not in computed:
+                amounts = self._get_price_total_and_subtotal_model(
+                    price_unit=entry['price_unit'],
+                    quantity=entry['quantity'],
+                    discount=entry['discount'],
+                    currency=move.currency_id,
+                    product=entry['product'],
+                    partner=move.partner_id,
+                    taxes=taxes,
+                    move_type=move.move_type,
+                )
+                computed[key] = (amounts['price_subtotal'], amounts['price_total'])
+            res.append(computed[key])
+        return res
+
+    @api.model
+    def _get_price_tax_rates(self, taxes, move):
+        ''' Get the rates of 'taxes' when 'compute_all' reduces to rounding the base and each tax amount: every tax is a
+        percentage excluded from the price, not affecting the base of the next taxes and has a single tax repartition
+        line of 100%, and the company rounds the taxes per line. 'compute_all' rounds each repartition line separately,
+        the other taxes may differ by a cent.
+
+        :return: The list of rates in percent or None when 'compute_all' is needed.
+        '''
+        company = taxes[:1].company_id or move.company_id
+        if company.tax_calculation_rounding_method != 'round_per_line':
+            return None
+
+        is_refund = move.move_type in ('out_refund', 'in_refund')
+        rates = []
+        for tax in taxes:
+            repartition_lines = tax.refund_repartition_line_ids if is_refund else tax.invoice_repartition_line_ids
+            tax_repartition_lines = repartition_lines.filtered(lambda line: line.repartition_type == 'tax')
+            if tax.amount_type != 'percent' or tax.price_include or tax.include_base_amount \
+                    or len(tax_repartition_lines) != 1 \
+                    or tools.float_compare(tax_repartition_lines.factor_percent, 100.0, precision_digits=4):
+                return None
+            rates.append(tax.amount)
+        return rates
+
+    @api.model
+    def _get_price_amounts_by_rates(self, price_unit, quantity, discount, currency, rates):
+        ''' Arithmetic counterpart of '_get_price_total_and_subtotal_model' for the rates of '_get_price_tax_rates'. '''
+        price_subtotal = currency.round(price_unit * (1 - (discount / 100.0)) * quantity)
+        price_total = price_subtotal
+        for rate in rates:
+            price_total += currency.round(price_subtotal * rate / 100)
+        return price_subtotal, currency.round(price_total)
+
+    @api.onchange('quantity', 'price_unit', 'discount', 'tax_ids')
     def _onchange_price_subtotal(self):
         for line in self:
             if not line.move_id.is_invoice(include_receipts=True):
@@ -168,7 +468,7 @@ class AccountGlobaLine(models.Model):
         return self._get_price_total_and_subtotal_model(
             price_unit=self.price_unit if price_unit is None else price_unit,
             quantity=self.quantity if quantity is None else quantity,
-            discount=discount if discount else 0.0,
+            discount=self.discount if discount is None else discount,
             currency=self.currency_id if currency is None else currency,
             product=self.product_id if product is None else product,
             partner=self.move_id.partner_id if partner is None else partner,
@@ -198,108 +498,162 @@ class AccountGlobaLine(models.Model):
             res = {k: currency.round(v) for k, v in res.items()}
         return res
 
-    def _prepare_edi_vals_to_export(self):
+    def _prepare_edi_vals_to_export(self, tax_context=None):
         ''' The purpose of this helper is the same as '_prepare_edi_vals_to_export' but for a single invoice line.
         This includes the computation of the tax details for each invoice line or the management of the discount.
         Indeed, in some EDI, we need to provide extra values depending the discount such as:
         - the discount as an amount instead of a percentage.
         - the price_unit but after subtraction of the discount.
 
+        :param tax_context: The optional values returned by '_get_global_tax_context' for the invoice of the line.
         :return: A python dict containing default pre-processed values.
         '''
         self.ensure_one()
+        table = self._get_global_edi_table(self.move_id, [self], tax_context=tax_context)
+        return dict(table[0].items())
 
-        if self.discount == 100.0:
-            gross_price_subtotal = self.currency_id.round(self.price_unit * self.quantity)
-        else:
-            gross_price_subtotal = self.currency_id.round(self.price_subtotal / (1 - self.discount / 100.0))
+    def _get_global_edi_table(self, invoice, line_groups, tax_context=None):
+        ''' Build the EDI values of the concepts of a global invoice in a compact 'GlobalLineEdiTable' instead of one
+        dict per line.
+        A group of many lines is exported as a single concept: the lines must share the product, unit of measure,
+        label, unit price, discount and taxes. Subtotals and totals are already rounded per line so their rounded sums
+        still match the total of the invoice.
+
+        :param invoice:     The global concept invoice.
+        :param line_groups: An iterable of account.global.line recordsets, one per concept.
+        :param tax_context: The optional values returned by '_get_global_tax_context' for the invoice.
+        :return: A GlobalLineEdiTable.
+        '''
+        if tax_context is None:
+            tax_context = self._get_global_tax_context(invoice)
+        currency = invoice.currency_id
+        table = GlobalLineEdiTable(invoice.global_lines, currency, tax_context)
+        for lines in line_groups:
+            if len(lines) == 1:
+                quantity = lines.quantity
+                price_subtotal = lines.price_subtotal
+                price_total = lines.price_total
+            else:
+                quantity = sum(lines.mapped('quantity'))
+                price_subtotal = currency.round(sum(lines.mapped('price_subtotal')))
+                price_total = currency.round(sum(lines.mapped('price_total')))
+
+            line = lines[:1]
+            if line.discount == 100.0:
+                gross_price_subtotal = currency.round(line.price_unit * quantity)
+            else:
+                gross_price_subtotal = currency.round(price_subtotal / (1 - line.discount / 100.0))
 
+            table.append(lines._ids, quantity, price_subtotal, price_total, gross_price_subtotal)
+        return table
+
+    def _get_consolidation_key(self):
+        ''' Lines sharing the same key are exported as a single concept when consolidating. '''
+        self.ensure_one()
+        return (
+            self.product_id,
+            self.product_uom_id,
+            self.name,
+            self.price_unit,
+            self.discount,
+            self.tax_ids,
+            self.l10n_mx_edi_customs_number,
+        )
+
+    @api.model
+    def _get_global_tax_context(self, invoice):
+        ''' Compute once per invoice everything the global tax details of a line depend on: the distinct taxes
+        of the global lines, the sign of the invoice, the currency rate and the CFDI tax codes.
+        The tax details of each line are then obtained by scaling these values by its subtotal.
+
+        :param invoice: The global concept invoice.
+        :return: A python dict with the 'transferred' and 'withholding' taxes split.
+        '''
+        taxes = invoice.global_lines.mapped("tax_ids")
+        currency_rate = invoice.currency_id.rate_ids[0].inverse_company_rate
         res = {
-            'line': self,
-            'price_unit_after_discount': self.currency_id.round(self.price_unit * (1 - (self.discount / 100.0))),
-            'price_subtotal_before_discount': gross_price_subtotal,
-            'price_subtotal_unit': self.currency_id.round(self.price_subtotal / self.quantity) if self.quantity else 0.0,
-            'price_total_unit': self.currency_id.round(self.price_total / self.quantity) if self.quantity else 0.0,
-            'price_discount': gross_price_subtotal - self.price_subtotal,
-            'price_discount_unit': (gross_price_subtotal - self.price_subtotal) / self.quantity if self.quantity else 0.0,
-            'gross_price_total_unit': self.currency_id.round(gross_price_subtotal / self.quantity) if self.quantity else 0.0,
-            'unece_uom_code': self.product_id.product_tmpl_id.uom_id._get_unece_code(),
-            'tax_details_transferred_global': self.get_tax_detail_transferred_global(self.move_id),
-            'tax_details_withholding_global': self.get_tax_detail_withholding_global(self.move_id)
+            'balance_multiplicator': -1 if invoice.is_inbound() else 1,
+            'currency_rate': currency_rate,
+            # Fixed-point values, see 'global_tax_engine'.
+            'currency_rate_fixed': global_tax_engine.currency_rate_to_fixed(currency_rate),
+            'currency_digits': invoice.currency_id.decimal_places,
+            'company_currency_digits': invoice.company_id.currency_id.decimal_places,
+            'transferred': {'total_tax_rate': 0.0, 'taxes': []},
+            'withholding': {'total_tax_rate': 0.0, 'taxes': []},
         }
+        for tax_id in taxes:
+            tax_vals = res['transferred'] if tax_id.amount >= 0 else res['withholding']
+            tax_vals['total_tax_rate'] += tax_id.amount
+            tax_vals['taxes'].append({
+                'tax': tax_id,
+                'amount': tax_id.amount,
+                'rate_ppm': global_tax_engine.rate_to_ppm(tax_id.amount),
+                'name': tax_id.name,
+                'cfdi_name': self.get_tax_cfdi_name(tax_id),
+            })
         return res
 
-    def get_tax_detail_transferred_global(self, invoice):
-        balance_multiplicator = -1 if invoice.is_inbound() else 1
-        currency_rate_save = invoice.currency_id.rate_ids[0].inverse_company_rate
-        total_tax_rate_transferred = 0.0
-        for x in invoice.global_lines.mapped("tax_ids.amount"):
-            if x >= 0:
-                total_tax_rate_transferred += x
-        values = {
-            'base_amount_currency': self.price_subtotal * balance_multiplicator,
-            'tax_amount_currency': self.price_subtotal * balance_multiplicator * (total_tax_rate_transferred/100),
-            'base_amount': self.price_subtotal * balance_multiplicator * currency_rate_save,
-            'tax_amount': self.price_subtotal * balance_multiplicator * (total_tax_rate_transferred/100) * currency_rate_save
-        }
+    @api.model
+    def _get_global_tax_detail(self, price_subtotal, tax_context, tax_type):
+        ''' Build the tax details of a global line from its subtotal and the precomputed '_get_global_tax_context'.
+        The amounts are computed in minor units and rounded half-up per tax, see 'global_tax_engine', so the totals of
+        the invoice are the sums of the amounts of its concepts.
+
+        :param price_subtotal:  The subtotal of the line.
+        :param tax_context:     The values returned by '_get_global_tax_context'.
+        :param tax_type:        Either 'transferred' or 'withholding'.
+        :return: A python dict containing the totals and the details per tax.
+        '''
+        digits = tax_context['currency_digits']
+        company_digits = tax_context['company_currency_digits']
+        currency_rate_fixed = tax_context['currency_rate_fixed']
+        base_units = global_tax_engine.to_minor_units(price_subtotal, digits) * tax_context['balance_multiplicator']
+        base_company_units = global_tax_engine.apply_currency_rate(base_units, currency_rate_fixed, digits, company_digits)
+        base_amount_currency = global_tax_engine.from_minor_units(base_units, digits)
+        base_amount = global_tax_engine.from_minor_units(base_company_units, company_digits)
+
+        tax_units_total = 0
+        tax_company_units_total = 0
         tax_detail = []
-        for tax_id in invoice.global_lines.mapped("tax_ids"):
-            if tax_id.amount >= 0:
-                line_val = {
-                    'base_amount': self.price_subtotal * balance_multiplicator * currency_rate_save,
-                    'tax_amount': self.price_subtotal * balance_multiplicator * (tax_id.amount/100) * currency_rate_save,
-                    'base_amount_currency': self.price_subtotal * balance_multiplicator,
-                    'tax_amount_currency': self.price_subtotal * balance_multiplicator * (tax_id.amount/100),
-                    'tax': tax_id,
-                    'exemption_reason': tax_id.name,
-                    'tax_rate_transferred': tax_id.amount / 100,
-                    'cfdi_name': self.get_tax_cfdi_name(tax_id)
-                }
-                tax_detail.append(line_val)
-        values["tax_details"] = tax_detail
-        return values
-
-    def get_tax_detail_withholding_global(self, invoice):
-        balance_multiplicator = -1 if invoice.is_inbound() else 1
-        currency_rate_save = invoice.currency_id.rate_ids[0].inverse_company_rate
-        total_tax_rate_transferred = 0.0
-        for x in invoice.global_lines.mapped("tax_ids.amount"):
-            if x < 0:
-                total_tax_rate_transferred += x
-        values = {
-            'base_amount_currency': self.price_subtotal * balance_multiplicator,
-            'tax_amount_currency': self.price_subtotal * balance_multiplicator * (total_tax_rate_transferred/100),
-            'base_amount': self.price_subtotal * balance_multiplicator * currency_rate_save,
-            'tax_amount': self.price_subtotal * balance_multiplicator * (total_tax_rate_transferred/100) * currency_rate_save
+        for tax_vals in tax_context[tax_type]['taxes']:
+            tax_units = global_tax_engine.apply_rate(base_units, tax_vals['rate_ppm'])
+            tax_company_units = global_tax_engine.apply_currency_rate(tax_units, currency_rate_fixed, digits, company_digits)
+            tax_units_total += tax_units
+            tax_company_units_total += tax_company_units
+            tax_line_vals = {
+                'base_amount': base_amount,
+                'tax_amount': global_tax_engine.from_minor_units(tax_company_units, company_digits),
+                'base_amount_currency': base_amount_currency,
+                'tax_amount_currency': global_tax_engine.from_minor_units(tax_units, digits),
+                'tax': tax_vals['tax'],
+                'exemption_reason': tax_vals['name'],
+                'tax_rate_transferred': tax_vals['amount'] / 100,
+                'cfdi_name': tax_vals['cfdi_name'],
+            }
+            if tax_type == 'withholding':
+                tax_line_vals['tax_rate_withholding'] = -tax_vals['amount'] / 100
+            tax_detail.append(tax_line_vals)
+        return {
+            'base_amount_currency': base_amount_currency,
+            'tax_amount_currency': global_tax_engine.from_minor_units(tax_units_total, digits),
+            'base_amount': base_amount,
+            'tax_amount': global_tax_engine.from_minor_units(tax_company_units_total, company_digits),
+            'tax_details': tax_detail,
         }
-        tax_detail = []
-        for tax_id in invoice.global_lines.mapped("tax_ids"):
-            if tax_id.amount < 0:
-                line_val = {
-                    'base_amount': self.price_subtotal * balance_multiplicator * currency_rate_save,
-                    'tax_amount': self.price_subtotal * balance_multiplicator * (tax_id.amount/100) * currency_rate_save,
-                    'base_amount_currency': self.price_subtotal * balance_multiplicator,
-                    'tax_amount_currency': self.price_subtotal * balance_multiplicator * (tax_id.amount/100),
-                    'tax': tax_id,
-                    'exemption_reason': tax_id.name,
-                    'tax_rate_transferred': tax_id.amount / 100,
-                    'cfdi_name': self.get_tax_cfdi_name(tax_id)
-                }
-                tax_detail.append(line_val)
-        values["tax_details"] = tax_detail
-        return values
+
+    def get_tax_detail_transferred_global(self, invoice, tax_context=None):
+        if tax_context is None:
+            tax_context = self._get_global_tax_context(invoice)
+        return self._get_global_tax_detail(self.price_subtotal, tax_context, 'transferred')
+
+    def get_tax_detail_withholding_global(self, invoice, tax_context=None):
+        if tax_context is None:
+            tax_context = self._get_global_tax_context(invoice)
+        return self._get_global_tax_detail(self.price_subtotal, tax_context, 'withholding')
 
     def _l10n_mx_edi_get_custom_numbers(self):
         return []
 
     def get_tax_cfdi_name(self, tax_id):
-        tags = set()
-        for tag in tax_id.invoice_repartition_line_ids.tag_ids:
-            tags.add(tag)
-        tags = list(tags)
-        if len(tags) == 1:
-            return {'ISR': '001', 'IVA': '002', 'IEPS': '003'}.get(tags[0].name)
-        elif tax_id.l10n_mx_tax_type == 'Exento':
-            return '002'
-        else:
-            return None
+        # Stored on the tax, see 'account.tax._compute_global_cfdi_tax_code'.
+        return tax_id.global_cfdi_tax_code or None
@@ -0,0 +1,18 @@
+from odoo import models, fields
+
+
+class AccountGlobalLineSource(models.Model):
+    ''' The documents, e.g. POS orders or sale orders, whose lines have been imported as global lines of an invoice,
+    see '_import_global_lines' on 'account.move'. A document can only be imported once, deleting the invoice releases
+    its documents.
+    '''
+    _name = "account.global.line.source"
+    _description = "Global Line Source"
+
+    move_id = fields.Many2one('account.move', string='Journal Entry', required=True, index=True, ondelete='cascade')
+    res_model = fields.Char(string='Modelo', required=True)
+    res_id = fields.Many2oneReference(string='Documento', model_field='res_model', required=True)
+
+    _sql_constraints = [
+        ('res_unique', 'unique(res_model, res_id)', 'El documento ya fue importado en otra factura global.'),
+    ]
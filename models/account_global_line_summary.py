@@ -0,0 +1,49 @@
+from odoo import api, models, fields, tools
+
+
+class AccountGlobalLineSummary(models.Model):
+    _name = "account.global.line.summary"
+    _description = "Global Lines Summary"
+    _auto = False
+    _order = "move_id, price_total desc"
+
+    move_id = fields.Many2one('account.move', string='Journal Entry', readonly=True)
+    product_id = fields.Many2one('product.product', string='Product', readonly=True)
+    tax_names = fields.Char(string='Taxes', readonly=True)
+    currency_id = fields.Many2one('res.currency', string='Currency', readonly=True)
+    line_count = fields.Integer(string='Lineas', readonly=True)
+    quantity = fields.Float(string='Quantity', digits='Product Unit of Measure', readonly=True)
+    price_subtotal = fields.Monetary(string='Subtotal', currency_field='currency_id', readonly=True)
+    price_total = fields.Monetary(string='Total', currency_field='currency_id', readonly=True)
+
+    def init(self):
+        ''' Aggregate the global lines of each invoice by product and set of taxes. '''
+        taxes_field = self.env['account.global.line']._fields['tax_ids']
+        tools.drop_view_if_exists(self._cr, self._table)
+        self._cr.execute('''
+            CREATE OR REPLACE VIEW {table} AS (
+                SELECT MIN(line.id) AS id,
+                       line.move_id,
+                       line.product_id,
+                       taxes.tax_names,
+                       line.currency_id,
+                       COUNT(*) AS line_count,
+                       SUM(line.quantity) AS quantity,
+                       SUM(line.price_subtotal) AS price_subtotal,
+                       SUM(line.price_total) AS price_total
+                FROM account_global_line line
+                LEFT JOIN LATERAL (
+                    SELECT STRING_AGG(rel.{tax_column}::text, ',' ORDER BY rel.{tax_column}) AS tax_key,
+                           STRING_AGG(tax.name, ', ' ORDER BY rel.{tax_column}) AS tax_names
+                    FROM {tax_relation} rel
+                    JOIN account_tax tax ON tax.id = rel.{tax_column}
+                    WHERE rel.{line_column} = line.id
+                ) AS taxes ON TRUE
+                GROUP BY line.move_id, line.product_id, line.currency_id, taxes.tax_key, taxes.tax_names
+            )
+        '''.format(
+            table=self._table,
+            tax_relation=taxes_field.relation,
+            tax_column=taxes_field.column2,
+            line_column=taxes_field.column1,
+        ))
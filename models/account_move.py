@@ -1,58 +1,596 @@
 from odoo import api, models, fields
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
 from collections import defaultdict
 import math
 from odoo.tools import frozendict
 
 
+class _DryRunRollback(Exception):
+    pass
+
+
 class AccountMove(models.Model):
     _inherit = "account.move"
 
     global_lines = fields.One2many(comodel_name="account.global.line", inverse_name="move_id", string="Concepto Global", )
     is_global_concept = fields.Boolean(string="Facturacion Concepto Global",  copy=False, )
+    global_line_summary_ids = fields.One2many(
+        comodel_name="account.global.line.summary", inverse_name="move_id", string="Resumen Conceptos", readonly=True)
+    global_line_count = fields.Integer(string="Lineas Globales", compute='_compute_global_line_count')
+    global_consolidate_concepts = fields.Boolean(
+        string="Agrupar Conceptos",
+        help="Export the global lines sharing product, unit of measure, label, price, discount and taxes as a single "
+             "concept in the CFDI.")
+    global_export_job_ids = fields.One2many(
+        comodel_name="account.global.export.job", inverse_name="move_id", string="Exportacion en segundo plano",
+        readonly=True, copy=False)
+    global_split_max_concepts = fields.Integer(
+        string="Conceptos por CFDI",
+        help="Split the global lines into several invoices, each one with at most this number of concepts, when "
+             "posting. 0 means no limit.")
+    global_split_max_bytes = fields.Integer(
+        string="Tamano maximo por CFDI (bytes)",
+        help="Split the global lines into several invoices, each one with a CFDI of about this size at most, when "
+             "posting. 0 means no limit.")
+    global_parent_id = fields.Many2one(
+        comodel_name="account.move", string="Factura Global Origen", readonly=True, copy=False, index=True,
+        help="The global invoice this invoice is a part of.")
+    global_chunk_ids = fields.One2many(
+        comodel_name="account.move", inverse_name="global_parent_id", string="Facturas Globales Parciales",
+        readonly=True, copy=False)
+    global_chunk_index = fields.Integer(string="Parte", readonly=True, copy=False)
+    global_cfdi_cache_key = fields.Char(
+        readonly=True, copy=False,
+        help="Hash of everything the cached global CFDI has been generated from, see "
+             "'account.edi.format._l10n_mx_edi_get_global_cfdi_cache_key'.")
+    global_cfdi_cache_file = fields.Binary(attachment=True, readonly=True, copy=False)
     amount_total_concept = fields.Monetary(
         string='Concepto Total',
-        readonly=True, compute='_amount_total_concept', currency_field='currency_id',)
+        readonly=True, store=True, compute='_amount_total_concept', currency_field='currency_id',)
 
     @api.depends(
         'global_lines.price_total',
         'global_lines.currency_id')
     def _amount_total_concept(self):
+        # Stored moves are summed in SQL to avoid loading all their global lines.
+        stored_moves = self.filtered(lambda move: isinstance(move.id, int))
+        totals = {}
+        if stored_moves:
+            for group in self.env['account.global.line'].read_group(
+                    [('move_id', 'in', stored_moves.ids)], ['price_total:sum'], ['move_id']):
+                totals[group['move_id'][0]] = group['price_total']
         for move in self:
-            total = 0.0
-            for line in move.global_lines:
-                total += line.price_total
-            move.amount_total_concept = total
+            if move in stored_moves:
+                move.amount_total_concept = totals.get(move.id, 0.0)
+            else:
+                total = 0.0
+                for line in move.global_lines:
+                    total += line.price_total
+                move.amount_total_concept = total
+
+    def _compute_global_line_count(self):
+        stored_moves = self.filtered(lambda move: isinstance(move.id, int))
+        counts = {}
+        if stored_moves:
+            for group in self.env['account.global.line'].read_group(
+                    [('move_id', 'in', stored_moves.ids)], ['move_id'], ['move_id']):
+                counts[group['move_id'][0]] = group['move_id_count']
+        for move in self:
+            move.global_line_count = counts.get(move.id, 0) if move in stored_moves else len(move.global_lines)
+
+    def action_open_global_lines(self):
+        ''' Open the global lines of the invoice in their own paginated list, instead of loading them all in the form. '''
+        self.ensure_one()
+        action = self.env['ir.actions.act_window']._for_xml_id('global_concepts.action_account_global_line')
+        editable = self.state == 'draft'
+        action.update({
+            'domain': [('move_id', '=', self.id)],
+            'context': {
+                'default_move_id': self.id,
+                'create': editable,
+                'edit': editable,
+                'delete': editable,
+            },
+        })
+        return action
+
+    @api.model
+    def _get_global_concept_check_fields(self):
+        ''' The fields whose update may break the equality between the invoice total and the global lines total. '''
+        return {'global_lines', 'is_global_concept', 'line_ids', 'invoice_line_ids', 'currency_id', 'state'}
 
     def write(self, vals):
         res = super().write(vals)
-        for record in self:
-            if record.is_global_concept and record.amount_total != record.amount_total_concept:
-                raise ValidationError(f"El monto global total {record.amount_total_concept} deber ser igual al monto de la factura: {record.amount_total}")
+        if self._get_global_concept_check_fields().intersection(vals):
+            for record in self:
+                # The global lines of a split invoice have been moved to its parts.
+                if record.global_chunk_ids:
+                    continue
+                if record.is_global_concept and record.amount_total != record.amount_total_concept:
+                    raise ValidationError(f"El monto global total {record.amount_total_concept} deber ser igual al monto de la factura: {record.amount_total}")
         return res
 
+    @api.model
+    def _get_global_line_import_sources(self):
+        ''' Describe the documents global lines can be imported from. Sources whose model is not installed are
+        ignored.
+
+        :return: A dict mapping each source to the fields used to aggregate its lines.
+        '''
+        return {
+            'pos': {
+                'model': 'pos.order.line',
+                'order_field': 'order_id',
+                'quantity_field': 'qty',
+                'uom_field': None,
+                'taxes_field': 'tax_ids',
+                'where': "src_order.state IN ('paid', 'done') AND src_order.account_move IS NULL",
+            },
+            'sale': {
+                'model': 'sale.order.line',
+                'order_field': 'order_id',
+                'quantity_field': 'qty_to_invoice',
+                'uom_field': 'product_uom',
+                'taxes_field': 'tax_id',
+                'where': "src_order.state IN ('sale', 'done') AND line.invoice_status = 'to invoice'",
+            },
+        }
+
+    def _get_global_line_import_query(self, source_vals):
+        ''' Build the query aggregating the lines of a source by product, unit of measure, price, discount and
+        set of taxes. The orders already imported in a global invoice, see 'account.global.line.source', are skipped.
+        '''
+        self.ensure_one()
+        line_model = self.env[source_vals['model']]
+        order_model = self.env[line_model._fields[source_vals['order_field']].comodel_name]
+        taxes_field = line_model._fields[source_vals['taxes_field']]
+        uom_column = 'line.%s' % source_vals['uom_field'] if source_vals['uom_field'] else 'NULL::integer'
+        return '''
+            SELECT source.product_id, source.uom_id, source.price_unit, source.discount, source.tax_ids,
+                   SUM(source.quantity) AS quantity,
+                   ARRAY_AGG(DISTINCT source.order_id) AS order_ids
+            FROM (
+                SELECT line.{order_field} AS order_id,
+                       line.product_id,
+                       {uom_column} AS uom_id,
+                       line.price_unit,
+                       COALESCE(line.discount, 0.0) AS discount,
+                       ARRAY(
+                           SELECT rel.{tax_column}
+                           FROM {tax_relation} rel
+                           WHERE rel.{line_column} = line.id
+                           ORDER BY rel.{tax_column}
+                       ) AS tax_ids,
+                       line.{quantity_field} AS quantity
+                FROM {line_table} line
+                JOIN {order_table} src_order ON src_order.id = line.{order_field}
+                WHERE line.product_id IS NOT NULL
+                AND src_order.company_id = %(company_id)s
+                AND src_order.date_order >= %(date_from)s
+                AND src_order.date_order < %(date_to)s
+                AND {where}
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM account_global_line_source consumed
+                    WHERE consumed.res_model = %(res_model)s
+                    AND consumed.res_id = src_order.id
+                )
+            ) AS source
+            GROUP BY source.product_id, source.uom_id, source.price_unit, source.discount, source.tax_ids
+            HAVING SUM(source.quantity) != 0
+            ORDER BY source.product_id, source.price_unit
+        '''.format(
+            uom_column=uom_column,
+            tax_relation=taxes_field.relation,
+            tax_column=taxes_field.column2,
+            line_column=taxes_field.column1,
+            quantity_field=source_vals['quantity_field'],
+            line_table=line_model._table,
+            order_table=order_model._table,
+            order_field=source_vals['order_field'],
+            where=source_vals['where'],
+        )
+
+    def _import_global_lines(self, date_from, date_to, sources=None, batch_size=1000):
+        ''' Populate the global lines of the invoice from the POS orders and/or sale orders of a period.
+        The source lines are aggregated by a single query per source and the global lines are created by batches.
+
+        :param date_from:   The first day of the period.
+        :param date_to:     The last day of the period.
+        :param sources:     The keys of '_get_global_line_import_sources' to use, all the installed ones by default.
+        :param batch_size:  The number of global lines created at once.
+        :return: The created account.global.line records.
+        '''
+        self.ensure_one()
+        if self.state != 'draft' or not self.is_global_concept:
+            raise UserError("Solo se pueden importar lineas globales en una factura en borrador de Concepto Global.")
+
+        all_sources = self._get_global_line_import_sources()
+        if sources is None:
+            sources = list(all_sources)
+
+        params = {
+            'company_id': self.company_id.id,
+            'date_from': fields.Date.to_date(date_from),
+            'date_to': fields.Date.add(fields.Date.to_date(date_to), days=1),
+        }
+        rows = []
+        source_vals_list = []
+        for source in sources:
+            source_vals = all_sources[source]
+            if source_vals['model'] not in self.env:
+                continue
+            line_model = self.env[source_vals['model']]
+            order_model_name = line_model._fields[source_vals['order_field']].comodel_name
+            line_model.flush()
+            self.env['account.global.line.source'].flush()
+            self._cr.execute(self._get_global_line_import_query(source_vals), dict(params, res_model=order_model_name))
+            source_rows = self._cr.dictfetchall()
+            order_ids = {order_id for row in source_rows for order_id in row['order_ids']}
+            source_vals_list += [{'move_id': self.id, 'res_model': order_model_name, 'res_id': order_id} for order_id in sorted(order_ids)]
+            rows += source_rows
+
+        # Map the taxes once per set of taxes.
+        mapped_taxes = {}
+        for row in rows:
+            tax_ids = tuple(row['tax_ids'])
+            if tax_ids not in mapped_taxes:
+                taxes = self.env['account.tax'].browse(tax_ids)
+                if taxes and self.fiscal_position_id:
+                    taxes = self.fiscal_position_id.map_tax(taxes)
+                mapped_taxes[tax_ids] = taxes.ids
+
+        # The lines without unit of measure get the one of their product, see '_prepare_product_default_vals'.
+        vals_list = []
+        for row in rows:
+            vals = {
+                'move_id': self.id,
+                'product_id': row['product_id'],
+                'quantity': row['quantity'],
+                'price_unit': row['price_unit'],
+                'discount': row['discount'],
+                'tax_ids': [(6, 0, mapped_taxes[tuple(row['tax_ids'])])],
+            }
+            if row['uom_id']:
+                vals['product_uom_id'] = row['uom_id']
+            vals_list.append(vals)
+
+        lines = self.env['account.global.line']
+        for index in range(0, len(vals_list), batch_size):
+            lines |= lines.create(vals_list[index:index + batch_size])
+        # Mark the orders as imported so that they are not imported a second time.
+        self.env['account.global.line.source'].sudo().create(source_vals_list)
+        return lines
+
+    @api.model
+    def _get_global_cfdi_cache_fields(self):
+        ''' The fields of the invoice the global CFDI depends on, the ones not installed are ignored. '''
+        return [
+            'name', 'move_type', 'invoice_date', 'l10n_mx_edi_post_time', 'company_id', 'partner_id', 'currency_id',
+            'fiscal_position_id', 'invoice_payment_term_id', 'invoice_date_due', 'amount_untaxed', 'amount_total',
+            'global_consolidate_concepts', 'l10n_mx_edi_usage', 'l10n_mx_edi_payment_method_id',
+            'l10n_mx_edi_payment_policy', 'l10n_mx_edi_origin',
+        ]
+
+    def _get_global_cfdi_digest(self):
+        ''' Digest in SQL the global lines, their taxes with the tags of their repartition lines and the journal items
+        of the invoice, without loading them.
+
+        :return: A list of md5 hexdigests.
+        '''
+        self.ensure_one()
+        self.flush()
+        taxes_field = self.env['account.global.line']._fields['tax_ids']
+        tags_field = self.env['account.tax.repartition.line']._fields['tag_ids']
+        self._cr.execute('''
+            SELECT
+                (
+                    SELECT md5(string_agg(concat_ws('|',
+                        line.id, line.product_id, line.product_uom_id, line.name, line.quantity, line.price_unit,
+                        line.discount, line.price_subtotal, line.price_total, line.l10n_mx_edi_customs_number,
+                        line.write_date,
+                        ARRAY(
+                            SELECT rel.{tax_column}
+                            FROM {tax_relation} rel
+                            WHERE rel.{line_column} = line.id
+                            ORDER BY rel.{tax_column}
+                        )
+                    ), ',' ORDER BY line.id))
+                    FROM account_global_line line
+                    WHERE line.move_id = %(move_id)s
+                ),
+                (
+                    SELECT md5(string_agg(concat_ws('|', tax.id, tax.write_date, rep.id, rep.write_date, tag.id, tag.name),
+                                          ',' ORDER BY tax.id, rep.id, tag.id))
+                    FROM account_tax tax
+                    LEFT JOIN account_tax_repartition_line rep ON rep.invoice_tax_id = tax.id
+                    LEFT JOIN {tag_relation} tag_rel ON tag_rel.{rep_column} = rep.id
+                    LEFT JOIN account_account_tag tag ON tag.id = tag_rel.{tag_column}
+                    WHERE tax.id IN (
+                        SELECT rel.{tax_column}
+                        FROM {tax_relation} rel
+                        JOIN account_global_line line ON line.id = rel.{line_column}
+                        WHERE line.move_id = %(move_id)s
+                    )
+                ),
+                (
+                    SELECT md5(string_agg(concat_ws('|', aml.id, aml.write_date), ',' ORDER BY aml.id))
+                    FROM account_move_line aml
+                    WHERE aml.move_id = %(move_id)s
+                )
+        '''.format(
+            tax_relation=taxes_field.relation,
+            tax_column=taxes_field.column2,
+            line_column=taxes_field.column1,
+            tag_relation=tags_field.relation,
+            rep_column=tags_field.column1,
+            tag_column=tags_field.column2,
+        ), {'move_id': self.id})
+        return list(self._cr.fetchone())
+
+    def _get_global_lines_consolidated(self):
+        ''' Group the equivalent global lines of the invoice, keeping the order of their first occurrence.
+
+        :return: A list of account.global.line recordsets, one per concept.
+        '''
+        self.ensure_one()
+        lines = self.global_lines
+        line_ids_by_key = defaultdict(list)
+        for line in lines:
+            line_ids_by_key[line._get_consolidation_key()].append(line.id)
+        return [lines.browse(line_ids).with_prefetch(lines._prefetch_ids) for line_ids in line_ids_by_key.values()]
+
+    def action_post(self):
+        # OVERRIDE
+        # The oversized global invoices are replaced by their parts, see '_split_global_lines'.
+        chunks_by_move = {move: move._get_global_line_chunks() for move in self}
+        to_split = self.filtered(lambda move: len(chunks_by_move[move]) > 1)
+        res = super(AccountMove, self - to_split).action_post() if self - to_split else False
+        if to_split:
+            to_split._split_global_lines(chunks_by_move=chunks_by_move).action_post()
+        return res
+
+    @api.model
+    def _get_global_concept_size(self, lines):
+        ''' Estimate the size in bytes of the 'Concepto' node of a group of global lines in the CFDI. '''
+        line = lines[:1]
+        return 450 + len(line.name or '') + 220 * len(line.tax_ids)
+
+    def _get_global_line_chunks(self):
+        ''' Partition the concepts of the invoice according to 'global_split_max_concepts' and
+        'global_split_max_bytes', keeping their order.
+
+        :return: A list of lists of account.global.line recordsets, one per concept, or an empty list when the invoice
+                 doesn't need to be split.
+        '''
+        self.ensure_one()
+        if not self.is_global_concept or not (self.global_split_max_concepts or self.global_split_max_bytes):
+            return []
+        # Iterating the global lines keeps them prefetched together.
+        line_groups = self._get_global_lines_consolidated() if self.global_consolidate_concepts \
+            else list(self.global_lines)
+
+        chunks = []
+        chunk = []
+        chunk_size = 0
+        for lines in line_groups:
+            size = self._get_global_concept_size(lines) if self.global_split_max_bytes else 0
+            if chunk and (
+                (self.global_split_max_concepts and len(chunk) >= self.global_split_max_concepts)
+                or (self.global_split_max_bytes and chunk_size + size > self.global_split_max_bytes)
+            ):
+                chunks.append(chunk)
+                chunk = []
+                chunk_size = 0
+            chunk.append(lines)
+            chunk_size += size
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _get_global_chunk_price_units(self, taxes, price_subtotal, price_total):
+        ''' Find the price units of the invoice lines having 'taxes' so their total is exactly 'price_total', the sum of
+        the rounded totals of the global lines. A single price unit close to 'price_subtotal' is looked for first, the
+        rounding of the taxes may need a second line of a few cents.
+
+        :return: A list of price units.
+        '''
+        self.ensure_one()
+        currency = self.currency_id
+
+        def get_total(price_unit):
+            if not taxes:
+                return price_unit
+            taxes_res = taxes.with_context(force_sign=1).compute_all(
+                price_unit, quantity=1.0, currency=currency, partner=self.partner_id,
+                is_refund=self.move_type in ('out_refund', 'in_refund'))
+            return currency.round(taxes_res['total_included'])
+
+        price_unit = currency.round(price_subtotal)
+        deltas = sorted(range(-10, 11), key=abs)
+        for delta in deltas:
+            candidate = currency.round(price_unit + delta * currency.rounding)
+            if currency.compare_amounts(get_total(candidate), price_total) == 0:
+                return [candidate]
+        for cents in range(1, 11):
+            extra_price_unit = currency.round(cents * currency.rounding)
+            extra_total = get_total(extra_price_unit)
+            for delta in deltas:
+                candidate = currency.round(price_unit - extra_price_unit + delta * currency.rounding)
+                if currency.compare_amounts(get_total(candidate) + extra_total, price_total) == 0:
+                    return [candidate, extra_price_unit]
+        raise UserError(f"No se pudo cuadrar el total {price_total} de los conceptos con impuestos {', '.join(taxes.mapped('name'))}")
+
+    @api.model
+    def _get_global_chunk_copied_fields(self):
+        ''' The fields of the invoice copied to its parts, the ones not installed are ignored. '''
+        return [
+            'move_type', 'partner_id', 'journal_id', 'company_id', 'invoice_date', 'date', 'currency_id',
+            'fiscal_position_id', 'invoice_payment_term_id', 'invoice_date_due', 'invoice_origin', 'ref',
+            'global_consolidate_concepts', 'l10n_mx_edi_usage', 'l10n_mx_edi_payment_method_id',
+        ]
+
+    def _get_global_invoice_lines_vals(self, lines, name):
+        ''' Prepare the invoice lines matching the global lines 'lines': one line per set of taxes, whose total is the
+        sum of the totals of the global lines, see '_get_global_chunk_price_units'.
+
+        :param lines:   An iterable of account.global.line records.
+        :param name:    The label of the invoice lines.
+        :return: A list of commands to create the invoice lines.
+        '''
+        self.ensure_one()
+        account = self.invoice_line_ids.account_id[:1] or self.journal_id.default_account_id
+
+        totals_by_taxes = defaultdict(lambda: [0.0, 0.0])
+        for line in lines:
+            totals = totals_by_taxes[line.tax_ids]
+            totals[0] += line.price_subtotal
+            totals[1] += line.price_total
+
+        invoice_line_vals_list = []
+        for taxes, (price_subtotal, price_total) in totals_by_taxes.items():
+            for price_unit in self._get_global_chunk_price_units(taxes, price_subtotal, price_total):
+                invoice_line_vals_list.append((0, 0, {
+                    'name': name,
+                    'account_id': account.id,
+                    'quantity': 1.0,
+                    'price_unit': price_unit,
+                    'tax_ids': [(6, 0, taxes.ids)],
+                }))
+        return invoice_line_vals_list
+
+    def _get_global_chunk_vals(self, index, chunk, chunk_count):
+        ''' Prepare the values of the part 'index' out of 'chunk_count' of the invoice, containing the concepts of 'chunk'.
+        An invoice line is created per set of taxes so the totals and the tax summary of the part match its global lines.
+        The part is created as a regular invoice, it becomes a global one once balanced, see '_split_global_lines'.
+        '''
+        self.ensure_one()
+        vals = {
+            fname: self._fields[fname].convert_to_write(self[fname], self)
+            for fname in self._get_global_chunk_copied_fields()
+            if fname in self._fields
+        }
+        vals.update({
+            'is_global_concept': False,
+            'global_parent_id': self.id,
+            'global_chunk_index': index,
+            'invoice_line_ids': self._get_global_invoice_lines_vals(
+                (line for lines in chunk for line in lines),
+                f"Venta al publico en general {index}/{chunk_count}",
+            ),
+        })
+        return vals
+
+    def _balance_global_invoice_lines(self, amount_total):
+        ''' Adjust the invoice lines so the total of the invoice is exactly 'amount_total'.
+        The price units of '_get_global_chunk_price_units' are found set of taxes by set of taxes, the total of the
+        invoice may still differ by a few cents when the taxes are rounded globally or shared by several sets of taxes.
+        The largest line is adjusted by the difference without its taxes; when the rounding of the taxes can't reach the
+        total, the remaining difference is set on a line without taxes.
+        '''
+        self.ensure_one()
+        currency = self.currency_id
+        seen_diffs = set()
+        while True:
+            diff = currency.round(amount_total - self.amount_total)
+            if currency.is_zero(diff):
+                return
+            if diff in seen_diffs or len(seen_diffs) >= 5:
+                break
+            seen_diffs.add(diff)
+
+            line = self.invoice_line_ids.sorted(lambda line: abs(line.price_subtotal), reverse=True)[:1]
+            rate = sum(line.tax_ids.filtered(lambda tax: tax.amount_type == 'percent').mapped('amount')) / 100.0
+            adjustment = currency.round(diff / (1 + rate))
+            if currency.is_zero(adjustment):
+                adjustment = math.copysign(currency.rounding, diff)
+            self.write({'invoice_line_ids': [(1, line.id, {'price_unit': currency.round(line.price_unit + adjustment)})]})
+
+        line = self.invoice_line_ids[:1]
+        self.write({'invoice_line_ids': [(0, 0, {
+            'name': line.name,
+            'account_id': line.account_id.id,
+            'quantity': 1.0,
+            'price_unit': diff,
+            'tax_ids': [(6, 0, [])],
+        })]})
+
+    def _split_global_lines(self, chunks_by_move=None):
+        ''' Replace the oversized global invoices by several invoices, each one with a part of their global lines, see
+        '_get_global_line_chunks'. The parts are posted and exported as separated CFDIs, in parallel by
+        'account.edi.format._l10n_mx_edi_export_global_cfdi_batch'. The original invoice is cancelled and keeps the
+        link to its parts.
+
+        :param chunks_by_move:  The results of '_get_global_line_chunks' already computed by invoice.
+        :return: The created account.move records.
+        '''
+        chunk_moves = self.env['account.move']
+        for move in self:
+            chunks = (chunks_by_move or {}).get(move) or move._get_global_line_chunks()
+            for index, chunk in enumerate(chunks, start=1):
+                chunk_move = self.create(move._get_global_chunk_vals(index, chunk, len(chunks)))
+                line_ids = [line_id for lines in chunk for line_id in lines.ids]
+                chunk_move._balance_global_invoice_lines(
+                    move.currency_id.round(sum(line.price_total for lines in chunk for line in lines)))
+                # The lines keep their amounts, the invoice of the part has the same currency, type and partner.
+                self.env['account.global.line'].browse(line_ids).write({'move_id': chunk_move.id})
+                # Checks the total of the part against its global lines, see 'write'.
+                chunk_move.is_global_concept = True
+                chunk_moves |= chunk_move
+        self.button_cancel()
+        return chunk_moves
+
+    def _dry_run_global_cfdi(self):
+        ''' Check the global invoices at once as their CFDI export would, without sealing the CFDI nor changing the
+        database: the invoices share the prefetching and the compiled XSD and XSLT, the durations are reported instead
+        of being stored as metrics. The CFDI date of the draft invoices is only set for the checks, everything is rolled
+        back at the end. Each invoice is checked in its own savepoint so an error only fails its own report.
+
+        :return: A dict mapping the invoice ids to the report of 'account.edi.format._l10n_mx_edi_dry_run_global_cfdi'.
+        '''
+        edi_format = self.env['account.edi.format'].search([('code', '=', 'cfdi_3_3')], limit=1)
+        reports = {}
+        try:
+            with self.env.cr.savepoint():
+                self.filtered(lambda move: not move.invoice_date).write({'invoice_date': fields.Date.context_today(self)})
+                self.filtered(lambda move: not move.l10n_mx_edi_post_time).write({'l10n_mx_edi_post_time': fields.Datetime.now()})
+                for move in self:
+                    reports[move.id] = edi_format._l10n_mx_edi_dry_run_global_cfdi(move)
+                raise _DryRunRollback()
+        except _DryRunRollback:
+            pass
+        return reports
+
     def _prepare_edi_vals_to_export(self):
         if not self.is_global_concept:
             values = super()._prepare_edi_vals_to_export()
             return values
         self.ensure_one()
 
+        # Taxes, sign and currency rate shared by all the global lines.
+        tax_context = self.env['account.global.line']._get_global_tax_context(self)
+
+        # Invoice lines details.
+        line_groups = self._get_global_lines_consolidated() if self.global_consolidate_concepts else self.global_lines
+        line_vals_table = self.env['account.global.line']._get_global_edi_table(self, line_groups, tax_context=tax_context)
+
         res = {
             'record': self,
             'balance_multiplicator': -1 if self.is_inbound() else 1,
-            'invoice_line_vals_list': [],
+            'invoice_line_vals_list': line_vals_table,
+            'global_tax_context': tax_context,
+            # Source global lines of each concept, for audit purpose.
+            'global_concept_line_ids': line_vals_table.get_concept_line_ids(),
         }
 
-        # Invoice lines details.
-        for index, line in enumerate(self.global_lines, start=1):
-            line_vals = line._prepare_edi_vals_to_export()
-            line_vals['index'] = index
-            res['invoice_line_vals_list'].append(line_vals)
-
         # Totals.
         res.update({
-            'total_price_subtotal_before_discount': sum(x['price_subtotal_before_discount'] for x in res['invoice_line_vals_list']),
-            'total_price_discount': sum(x['price_discount'] for x in res['invoice_line_vals_list']),
+            'total_price_subtotal_before_discount': sum(line_vals_table.price_subtotal_before_discount),
+            'total_price_discount': sum(
+                gross_price_subtotal - price_subtotal
+                for gross_price_subtotal, price_subtotal
+                in zip(line_vals_table.price_subtotal_before_discount, line_vals_table.price_subtotal)
+            ),
         })
         # Global Concept
         res.update({
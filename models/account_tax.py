@@ -0,0 +1,21 @@
+from odoo import api, models, fields
+
+
+class AccountTax(models.Model):
+    _inherit = "account.tax"
+
+    global_cfdi_tax_code = fields.Char(
+        string="Codigo Impuesto CFDI",
+        store=True, readonly=True, compute='_compute_global_cfdi_tax_code',
+        help="Value of the attribute 'Impuesto' of the global CFDI: 001 (ISR), 002 (IVA) or 003 (IEPS).")
+
+    @api.depends('invoice_repartition_line_ids.tag_ids.name', 'l10n_mx_tax_type')
+    def _compute_global_cfdi_tax_code(self):
+        for tax in self:
+            tags = tax.invoice_repartition_line_ids.tag_ids
+            if len(tags) == 1:
+                tax.global_cfdi_tax_code = {'ISR': '001', 'IVA': '002', 'IEPS': '003'}.get(tags.name)
+            elif tax.l10n_mx_tax_type == 'Exento':
+                tax.global_cfdi_tax_code = '002'
+            else:
+                tax.global_cfdi_tax_code = False
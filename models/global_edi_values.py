@@ -0,0 +1,222 @@
+from array import array
+from collections.abc import Mapping, Sequence
+
+
+class GlobalLineEdiTable(Sequence):
+    ''' Compact storage of the EDI values of the concepts of a global invoice, used as 'invoice_line_vals_list' by
+    'account.move._prepare_edi_vals_to_export'.
+
+    The amounts of the concepts are stored in arrays of doubles and the ids of their global lines in an array of
+    integers. Items are 'GlobalLineEdiValues' built on access, which behave like the dict returned by
+    'account.global.line._prepare_edi_vals_to_export'. The tax details are not stored: they are computed on access
+    from the subtotal of the concept and the taxes of the invoice shared in 'tax_context', see
+    'account.global.line._get_global_tax_context'.
+    '''
+
+    def __init__(self, lines, currency, tax_context):
+        self.lines = lines
+        self.currency = currency
+        self.tax_context = tax_context
+        self.line_ids = array('q')
+        self.line_offsets = array('q', [0])
+        self.quantity = array('d')
+        self.price_subtotal = array('d')
+        self.price_total = array('d')
+        self.price_subtotal_before_discount = array('d')
+        # Values set on the items by the callers, see 'GlobalLineEdiValues.__setitem__'.
+        self.extra_values = {}
+
+    def append(self, line_ids, quantity, price_subtotal, price_total, price_subtotal_before_discount):
+        self.line_ids.extend(line_ids)
+        self.line_offsets.append(len(self.line_ids))
+        self.quantity.append(quantity)
+        self.price_subtotal.append(price_subtotal)
+        self.price_total.append(price_total)
+        self.price_subtotal_before_discount.append(price_subtotal_before_discount)
+
+    def __len__(self):
+        return len(self.quantity)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return GlobalLineEdiValues(self, position)
+
+    def get_line_ids(self, position):
+        return list(self.line_ids[self.line_offsets[position]:self.line_offsets[position + 1]])
+
+    def get_lines(self, position):
+        return self.lines.browse(self.get_line_ids(position)).with_prefetch(self.lines._prefetch_ids)
+
+    def get_tax_detail(self, position, tax_type):
+        return self.lines._get_global_tax_detail(self.price_subtotal[position], self.tax_context, tax_type)
+
+    def get_tax_details(self, tax_type):
+        return GlobalTaxDetails(self, tax_type)
+
+    def get_concept_line_ids(self):
+        return GlobalConceptLineIds(self)
+
+
+class GlobalLineEdiValues:
+    ''' The EDI values of a concept stored in a 'GlobalLineEdiTable'. '''
+
+    __slots__ = ('table', 'position')
+
+    KEYS = (
+        'line', 'lines', 'index', 'quantity', 'price_subtotal', 'price_total', 'price_unit_after_discount',
+        'price_subtotal_before_discount', 'price_subtotal_unit', 'price_total_unit', 'price_discount',
+        'price_discount_unit', 'gross_price_total_unit', 'unece_uom_code', 'tax_details_transferred_global',
+        'tax_details_withholding_global',
+    )
+
+    def __init__(self, table, position):
+        self.table = table
+        self.position = position
+
+    def __getitem__(self, key):
+        extra_values = self.table.extra_values.get(self.position)
+        if extra_values and key in extra_values:
+            return extra_values[key]
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        self.table.extra_values.setdefault(self.position, {})[key] = value
+
+    def __contains__(self, key):
+        return key in self.KEYS or key in self.table.extra_values.get(self.position, {})
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.KEYS) + list(self.table.extra_values.get(self.position, {}))
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    @property
+    def line(self):
+        return self.lines[:1]
+
+    @property
+    def lines(self):
+        return self.table.get_lines(self.position)
+
+    @property
+    def index(self):
+        return self.position + 1
+
+    @property
+    def quantity(self):
+        return self.table.quantity[self.position]
+
+    @property
+    def price_subtotal(self):
+        return self.table.price_subtotal[self.position]
+
+    @property
+    def price_total(self):
+        return self.table.price_total[self.position]
+
+    @property
+    def price_subtotal_before_discount(self):
+        return self.table.price_subtotal_before_discount[self.position]
+
+    @property
+    def price_unit_after_discount(self):
+        line = self.line
+        return self.table.currency.round(line.price_unit * (1 - (line.discount / 100.0)))
+
+    @property
+    def price_subtotal_unit(self):
+        quantity = self.quantity
+        return self.table.currency.round(self.price_subtotal / quantity) if quantity else 0.0
+
+    @property
+    def price_total_unit(self):
+        quantity = self.quantity
+        return self.table.currency.round(self.price_total / quantity) if quantity else 0.0
+
+    @property
+    def price_discount(self):
+        return self.price_subtotal_before_discount - self.price_subtotal
+
+    @property
+    def price_discount_unit(self):
+        quantity = self.quantity
+        return (self.price_subtotal_before_discount - self.price_subtotal) / quantity if quantity else 0.0
+
+    @property
+    def gross_price_total_unit(self):
+        quantity = self.quantity
+        return self.table.currency.round(self.price_subtotal_before_discount / quantity) if quantity else 0.0
+
+    @property
+    def unece_uom_code(self):
+        return self.line.product_id.product_tmpl_id.uom_id._get_unece_code()
+
+    @property
+    def tax_details_transferred_global(self):
+        return self.table.get_tax_detail(self.position, 'transferred')
+
+    @property
+    def tax_details_withholding_global(self):
+        return self.table.get_tax_detail(self.position, 'withholding')
+
+
+class GlobalTaxDetails(Sequence):
+    ''' The tax details of all the concepts of a 'GlobalLineEdiTable', in the order of the concepts, computed on
+    access instead of being kept in a list.
+    '''
+
+    def __init__(self, table, tax_type):
+        self.table = table
+        self.tax_type = tax_type
+        self.tax_count = len(table.tax_context[tax_type]['taxes'])
+
+    def __len__(self):
+        return len(self.table) * self.tax_count
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        line_position, tax_position = divmod(position, self.tax_count)
+        return self.table.get_tax_detail(line_position, self.tax_type)['tax_details'][tax_position]
+
+    def __iter__(self):
+        if not self.tax_count:
+            return
+        for position in range(len(self.table)):
+            yield from self.table.get_tax_detail(position, self.tax_type)['tax_details']
+
+
+class GlobalConceptLineIds(Mapping):
+    ''' Map the index of each concept of a 'GlobalLineEdiTable' to the ids of its global lines. '''
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, index):
+        if not isinstance(index, int) or not 1 <= index <= len(self.table):
+            raise KeyError(index)
+        return self.table.get_line_ids(index - 1)
+
+    def __iter__(self):
+        return iter(range(1, len(self.table) + 1))
+
+    def __len__(self):
+        return len(self.table)
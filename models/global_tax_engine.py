@@ -0,0 +1,88 @@
+''' Fixed-point computation of the taxes of the global concepts.
+
+Amounts are handled as integers of minor units of the currency (cents for 2 digits) and tax rates as integers of
+parts per million of the base (16% is 160000), so the amounts of the concepts are rounded once, half-up as required by
+the SAT, and the totals of the invoice are exactly the sums of these rounded amounts.
+'''
+from decimal import Decimal, ROUND_HALF_UP
+
+RATE_PRECISION = 10 ** 6
+CURRENCY_RATE_PRECISION = 10 ** 12
+
+
+def div_half_up(numerator, denominator):
+    ''' Integer division of 'numerator' by the positive 'denominator', rounded half away from zero. '''
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if 2 * remainder >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def to_minor_units(amount, digits):
+    ''' Convert an amount already rounded to 'digits' decimals, e.g. a subtotal, to minor units. '''
+    return int(round(amount * 10 ** digits))
+
+
+def round_to_minor_units(amount, digits):
+    ''' Convert any amount to minor units, rounded half-up. '''
+    return int(Decimal(repr(amount)).scaleb(digits).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_minor_units(units, digits):
+    return units / 10 ** digits
+
+
+def rate_to_ppm(percent):
+    ''' Convert a tax rate expressed in percent, e.g. 16.0, to parts per million of the base. '''
+    return round_to_minor_units(percent, 4)
+
+
+def currency_rate_to_fixed(currency_rate):
+    return round_to_minor_units(currency_rate, 12)
+
+
+def apply_rate(base_units, rate_ppm):
+    ''' The tax amount in minor units of a base in minor units. '''
+    return div_half_up(base_units * rate_ppm, RATE_PRECISION)
+
+
+def apply_currency_rate(units, currency_rate_fixed, digits, company_digits):
+    ''' Convert minor units of the invoice currency to minor units of the company currency. '''
+    return div_half_up(units * currency_rate_fixed * 10 ** company_digits, CURRENCY_RATE_PRECISION * 10 ** digits)
+
+
+def compute_tax_totals(price_subtotals, tax_context, tax_type):
+    ''' Compute in bulk the totals of the tax details of 'tax_type' of all the concepts, see
+    'account.global.line._get_global_tax_detail' for the details of a single concept.
+
+    :param price_subtotals: An iterable of the subtotals of the concepts, rounded to the currency.
+    :param tax_context:     The values returned by 'account.global.line._get_global_tax_context'.
+    :param tax_type:        Either 'transferred' or 'withholding'.
+    :return: A python dict with the totals of the tax details, in minor units of the invoice currency and of the
+             company currency.
+    '''
+    digits = tax_context['currency_digits']
+    company_digits = tax_context['company_currency_digits']
+    currency_rate_fixed = tax_context['currency_rate_fixed']
+    balance_multiplicator = tax_context['balance_multiplicator']
+    rates_ppm = [tax_vals['rate_ppm'] for tax_vals in tax_context[tax_type]['taxes']]
+
+    base_units_total = 0
+    base_company_units_total = 0
+    tax_units_total = 0
+    tax_company_units_total = 0
+    for price_subtotal in price_subtotals:
+        base_units = to_minor_units(price_subtotal, digits) * balance_multiplicator
+        base_company_units = apply_currency_rate(base_units, currency_rate_fixed, digits, company_digits)
+        for rate_ppm in rates_ppm:
+            tax_units = apply_rate(base_units, rate_ppm)
+            base_units_total += base_units
+            base_company_units_total += base_company_units
+            tax_units_total += tax_units
+            tax_company_units_total += apply_currency_rate(tax_units, currency_rate_fixed, digits, company_digits)
+    return {
+        'base_amount_currency': base_units_total,
+        'tax_amount_currency': tax_units_total,
+        'base_amount': base_company_units_total,
+        'tax_amount': tax_company_units_total,
+    }
@@ -0,0 +1,3 @@
+from . import test_global_concepts
+from . import test_global_concepts_benchmark
+from . import test_global_tax_engine
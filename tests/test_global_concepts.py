@@ -0,0 +1,177 @@
+from odoo import fields, tools
+from odoo.addons.l10n_mx_edi.tests.common import TestMxEdiCommon
+from odoo.tests import tagged
+
+from freezegun import freeze_time
+from lxml import etree
+
+
+@tagged('post_install', '-at_install')
+class TestGlobalConcepts(TestMxEdiCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref='l10n_mx.mx_coa', edi_format_ref='l10n_mx_edi.edi_cfdi_3_3'):
+        super().setUpClass(chart_template_ref=chart_template_ref, edi_format_ref=edi_format_ref)
+
+    def _create_global_invoice(self, global_lines_vals, invoice_lines_vals, **kwargs):
+        return self.env['account.move'].with_context(default_move_type='out_invoice').create({
+            'move_type': 'out_invoice',
+            'partner_id': self.partner_a.id,
+            'invoice_date': '2017-01-01',
+            'date': '2017-01-01',
+            'is_global_concept': True,
+            'invoice_line_ids': [(0, 0, vals) for vals in invoice_lines_vals],
+            'global_lines': [(0, 0, vals) for vals in global_lines_vals],
+            **kwargs,
+        })
+
+    def _get_global_line_vals(self, price_unit, quantity=1.0, taxes=None):
+        return {
+            'product_id': self.product.id,
+            'product_uom_id': self.product.uom_id.id,
+            'price_unit': price_unit,
+            'quantity': quantity,
+            'tax_ids': [(6, 0, (self.tax_16 if taxes is None else taxes).ids)],
+        }
+
+    def test_consolidated_concepts_total(self):
+        invoice = self._create_global_invoice(
+            [self._get_global_line_vals(100.0)] * 3 + [self._get_global_line_vals(50.0, quantity=2.0)] * 2,
+            [{'product_id': self.product.id, 'price_unit': 500.0, 'tax_ids': [(6, 0, self.tax_16.ids)]}],
+            global_consolidate_concepts=True,
+        )
+        self.assertRecordValues(invoice, [{'amount_untaxed': 500.0, 'amount_total': 580.0, 'amount_total_concept': 580.0}])
+
+        edi_vals = invoice._prepare_edi_vals_to_export()
+        line_vals_table = edi_vals['invoice_line_vals_list']
+        self.assertEqual(len(line_vals_table), 2)
+        self.assertEqual([line_vals['quantity'] for line_vals in line_vals_table], [3.0, 4.0])
+        self.assertEqual([len(line_vals['lines']) for line_vals in line_vals_table], [3, 2])
+        self.assertAlmostEqual(sum(line_vals['price_subtotal'] for line_vals in line_vals_table), invoice.amount_untaxed)
+        self.assertAlmostEqual(sum(line_vals['price_total'] for line_vals in line_vals_table), invoice.amount_total)
+
+    def _create_withholding_global_invoice(self):
+        # The taxes of the invoice apply to all its concepts.
+        taxes = self.tax_16 + self.tax_10_negative
+        return self._create_global_invoice(
+            [self._get_global_line_vals(100.0, taxes=taxes), self._get_global_line_vals(50.0, quantity=2.0, taxes=taxes)],
+            [{'product_id': self.product.id, 'price_unit': 200.0, 'tax_ids': [(6, 0, taxes.ids)]}],
+        )
+
+    def test_stream_writer_matches_template(self):
+        invoice = self._create_withholding_global_invoice()
+        config_parameter = self.env['ir.config_parameter'].sudo()
+        cfdi_nodes = {}
+        with freeze_time(self.frozen_today):
+            invoice.l10n_mx_edi_post_time = fields.Datetime.now()
+            for writer in ('qweb', 'stream'):
+                config_parameter.set_param('global_concepts.cfdi_writer', writer)
+                cfdi_values = self.edi_format._l10n_mx_edi_get_invoice_cfdi_values(invoice)
+                cfdi_nodes[writer] = self.edi_format._l10n_mx_edi_render_global_cfdi(cfdi_values)
+
+        self.assertEqual(
+            etree.tostring(cfdi_nodes['stream'], method='c14n'),
+            etree.tostring(cfdi_nodes['qweb'], method='c14n'),
+        )
+
+    def test_global_cfdi_seal(self):
+        invoice = self._create_withholding_global_invoice()
+        certificate = invoice.company_id.l10n_mx_edi_certificate_ids.sudo()._get_valid_certificate()
+        with tools.file_open('l10n_mx_edi_40/data/4.0/cadenaoriginal_4_0.xslt', 'rb') as xslt_file:
+            cadena_transform = etree.XSLT(etree.parse(xslt_file))
+
+        config_parameter = self.env['ir.config_parameter'].sudo()
+        with freeze_time(self.frozen_today):
+            invoice.l10n_mx_edi_post_time = fields.Datetime.now()
+            for writer in ('qweb', 'stream'):
+                config_parameter.set_param('global_concepts.cfdi_writer', writer)
+                results = [
+                    self.edi_format._l10n_mx_edi_export_global_cfdi(invoice, None),
+                    self.edi_format._l10n_mx_edi_export_global_cfdi_batch(invoice)[invoice.id],
+                ]
+                for res in results:
+                    cfdi_node = etree.fromstring(res['cfdi_str'])
+                    # The seal is the one of the cadena of the Comprobante 4.0, not of the TimbreFiscalDigital.
+                    cadena = str(cadena_transform(cfdi_node))
+                    self.assertEqual(cfdi_node.get('Sello'), certificate.get_encrypted_cadena(cadena).decode(), writer)
+
+    def test_dry_run_global_cfdi(self):
+        invoice = self._create_withholding_global_invoice()
+        with freeze_time(self.frozen_today):
+            report = invoice._dry_run_global_cfdi()[invoice.id]
+
+        self.assertEqual(report['errors'], [])
+        self.assertEqual(report['concept_count'], 2)
+        self.assertEqual(report['amount_total_cfdi'], 212.0)
+        self.assertEqual(report['tax_totals'], {'transferred': 32.0, 'withholding': 20.0})
+        # The CFDI date set for the checks is rolled back.
+        self.assertFalse(invoice.l10n_mx_edi_post_time)
+
+    def _create_split_global_invoice(self):
+        # 4 concepts of 11.98 (10.33 + 1.65 of taxes), split into 2 invoices of 2 concepts.
+        return self._create_global_invoice(
+            [self._get_global_line_vals(10.33)] * 4,
+            [{'product_id': self.product.id, 'price_unit': 41.31, 'tax_ids': [(6, 0, self.tax_16.ids)]}],
+            global_split_max_concepts=2,
+        )
+
+    def test_split_global_line_chunks(self):
+        invoice = self._create_global_invoice(
+            [self._get_global_line_vals(100.0)] * 5,
+            [{'product_id': self.product.id, 'price_unit': 500.0, 'tax_ids': [(6, 0, self.tax_16.ids)]}],
+            global_split_max_concepts=2,
+        )
+        chunks = invoice._get_global_line_chunks()
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual([lines.id for chunk in chunks for lines in chunk], invoice.global_lines.ids)
+
+        invoice.global_split_max_concepts = 0
+        self.assertEqual(invoice._get_global_line_chunks(), [])
+
+    def test_split_global_chunk_price_units(self):
+        invoice = self._create_split_global_invoice()
+        # 20.66 gives 23.97 once the taxes are rounded, the total of the concepts needs a second line of one cent.
+        self.assertEqual(invoice._get_global_chunk_price_units(self.tax_16, 20.66, 23.96), [20.65, 0.01])
+        self.assertEqual(invoice._get_global_chunk_price_units(self.tax_16, 200.0, 232.0), [200.0])
+
+    def test_split_global_lines_post(self):
+        invoice = self._create_split_global_invoice()
+        with freeze_time(self.frozen_today):
+            invoice.action_post()
+
+        chunk_moves = invoice.global_chunk_ids.sorted('global_chunk_index')
+        self.assertEqual(invoice.state, 'cancel')
+        self.assertFalse(invoice.global_lines)
+        self.assertRecordValues(chunk_moves, [
+            {'state': 'posted', 'is_global_concept': True, 'global_chunk_index': 1, 'amount_total': 23.96, 'amount_total_concept': 23.96},
+            {'state': 'posted', 'is_global_concept': True, 'global_chunk_index': 2, 'amount_total': 23.96, 'amount_total_concept': 23.96},
+        ])
+        self.assertEqual(chunk_moves.global_lines.mapped('price_total'), [11.98] * 4)
+
+    def test_split_global_lines_round_globally(self):
+        self.company_data['company'].tax_calculation_rounding_method = 'round_globally'
+        invoice = self._create_split_global_invoice()
+        self.assertRecordValues(invoice, [{'amount_total': 47.92, 'amount_total_concept': 47.92}])
+        with freeze_time(self.frozen_today):
+            invoice.action_post()
+
+        # 20.66 of taxes rounded globally give 3.31 instead of the 3.30 of the concepts.
+        self.assertRecordValues(invoice.global_chunk_ids.sorted('global_chunk_index'), [
+            {'state': 'posted', 'amount_total': 23.96, 'amount_total_concept': 23.96},
+            {'state': 'posted', 'amount_total': 23.96, 'amount_total_concept': 23.96},
+        ])
+
+    def test_split_global_lines_repost(self):
+        invoice = self._create_split_global_invoice()
+        with freeze_time(self.frozen_today):
+            invoice.action_post()
+            chunk_move = invoice.global_chunk_ids.sorted('global_chunk_index')[:1]
+            chunk_move.button_draft()
+            chunk_move.action_post()
+
+        # The part is posted again as is, without being split.
+        self.assertRecordValues(chunk_move, [
+            {'state': 'posted', 'amount_total': 23.96, 'amount_total_concept': 23.96},
+        ])
+        self.assertFalse(chunk_move.global_chunk_ids)
+        self.assertEqual(len(chunk_move.global_lines), 2)
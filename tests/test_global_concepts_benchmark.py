@@ -0,0 +1,139 @@
+''' Benchmark of the global concept invoices.
+
+Not part of the standard test suite, run it on a local database with:
+
+    odoo-bin -d <db> -i global_concepts --test-tags global_concepts_benchmark --stop-after-init
+
+The environment variables GLOBAL_CONCEPTS_BENCH_SIZES (comma separated line counts, default '1000,10000,100000') and
+GLOBAL_CONCEPTS_BENCH_OUTPUT (path of the JSON report) allow to configure it. Each stage reports its duration and its
+number of queries so that two reports can be diffed between versions.
+
+Tracing the allocations slows the code down unevenly, so the peak of allocated memory of each stage is measured in a
+separate run, with GLOBAL_CONCEPTS_BENCH_MEMORY set, which doesn't report the durations.
+'''
+from odoo import fields
+from odoo.addons.l10n_mx_edi.tests.common import TestMxEdiCommon
+from odoo.tests import tagged
+
+from freezegun import freeze_time
+
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install', '-standard', 'global_concepts_benchmark')
+class TestGlobalConceptsBenchmark(TestMxEdiCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref='l10n_mx.mx_coa', edi_format_ref='l10n_mx_edi.edi_cfdi_3_3'):
+        super().setUpClass(chart_template_ref=chart_template_ref, edi_format_ref=edi_format_ref)
+
+        cls.tax_0 = cls.tax_16.copy({'name': 'IVA 0%', 'amount': 0.0})
+        cls.tax_exento = cls.tax_16.copy({'name': 'IVA Exento', 'amount': 0.0, 'l10n_mx_tax_type': 'Exento'})
+        cls.tax_iva_withholding = cls.tax_16.copy({'name': 'IVA Retenido', 'amount': -10.6667})
+        cls.tax_isr_withholding = cls.tax_10_negative
+        # Tax sets used in turn by the generated lines.
+        cls.tax_mix = [
+            cls.tax_16,
+            cls.tax_0,
+            cls.tax_exento,
+            cls.tax_16 + cls.tax_iva_withholding + cls.tax_isr_withholding,
+        ]
+
+        sizes = os.environ.get('GLOBAL_CONCEPTS_BENCH_SIZES', '1000,10000,100000')
+        cls.sizes = [int(size) for size in sizes.split(',') if size.strip()]
+        cls.output_path = os.environ.get('GLOBAL_CONCEPTS_BENCH_OUTPUT') \
+            or os.path.join(tempfile.gettempdir(), 'global_concepts_benchmark.json')
+        cls.trace_memory = bool(os.environ.get('GLOBAL_CONCEPTS_BENCH_MEMORY'))
+        cls.results = []
+
+    def _measure(self, stage, size, func):
+        ''' Run 'func' and record its duration and number of queries, or its peak of allocated memory only when
+        tracing the memory.
+        '''
+        self.env['base'].flush()
+        query_count = self.cr.sql_log_count
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        res = func()
+        self.env['base'].flush()
+        duration = time.perf_counter() - start
+        result = {
+            'size': size,
+            'stage': stage,
+            'queries': self.cr.sql_log_count - query_count,
+        }
+        if self.trace_memory:
+            result['memory_peak_kib'] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        else:
+            result['duration'] = round(duration, 4)
+        self.results.append(result)
+        _logger.info("Global concepts benchmark: %s", json.dumps(result))
+        return res
+
+    def _create_global_invoice(self):
+        # Becomes a global invoice once its invoice lines match its global lines, see '_set_global_invoice_lines'.
+        return self.env['account.move'].with_context(default_move_type='out_invoice').create({
+            'move_type': 'out_invoice',
+            'partner_id': self.partner_a.id,
+            'invoice_date': '2017-01-01',
+            'date': '2017-01-01',
+        })
+
+    def _set_global_invoice_lines(self, invoice):
+        ''' Create the invoice lines matching the global lines, as for the parts of a split invoice, and set the
+        posting time the CFDI is dated with.
+        '''
+        invoice.write({
+            'invoice_line_ids': invoice._get_global_invoice_lines_vals(invoice.global_lines, "Venta al publico en general"),
+        })
+        invoice._balance_global_invoice_lines(invoice.amount_total_concept)
+        invoice.write({
+            'is_global_concept': True,
+            'l10n_mx_edi_post_time': fields.Datetime.now(),
+        })
+
+    def _get_global_lines_vals(self, invoice, size):
+        return [{
+            'move_id': invoice.id,
+            'product_id': self.product.id,
+            'product_uom_id': self.product.uom_id.id,
+            'quantity': 1 + index % 5,
+            'price_unit': 10.0 + index % 97,
+            'tax_ids': [(6, 0, self.tax_mix[index % len(self.tax_mix)].ids)],
+        } for index in range(size)]
+
+    def _benchmark_size(self, size):
+        invoice = self._create_global_invoice()
+        vals_list = self._get_global_lines_vals(invoice, size)
+
+        self._measure('create_lines', size, lambda: self.env['account.global.line'].create(vals_list))
+        self._measure('set_invoice_lines', size, lambda: self._set_global_invoice_lines(invoice))
+        self._measure('amount_total_concept', size, invoice._amount_total_concept)
+        edi_vals = self._measure('prepare_edi_vals_to_export', size, invoice._prepare_edi_vals_to_export)
+        self._measure('get_tax_detail_transferred_global', size,
+                      lambda: self.edi_format.get_tax_detail_transferred_global(edi_vals))
+        self._measure('get_tax_details_withholding_global', size,
+                      lambda: self.edi_format.get_tax_details_withholding_global(edi_vals))
+        self._measure('export_invoice_cfdi', size,
+                      lambda: self.edi_format._l10n_mx_edi_export_invoice_cfdi(invoice))
+        # Retry after a PAC failure, served by the CFDI cache.
+        self._measure('export_invoice_cfdi_cached', size,
+                      lambda: self.edi_format._l10n_mx_edi_export_invoice_cfdi(invoice))
+
+    def test_benchmark_global_concepts(self):
+        with freeze_time(self.frozen_today):
+            for size in self.sizes:
+                self._benchmark_size(size)
+
+        with open(self.output_path, 'w') as output:
+            json.dump(self.results, output, indent=4)
+        _logger.info("Global concepts benchmark written in %s", self.output_path)
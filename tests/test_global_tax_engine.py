@@ -0,0 +1,72 @@
+from odoo.addons.global_concepts.models import global_tax_engine
+from odoo.tests.common import BaseCase, TransactionCase
+
+
+class TestGlobalTaxEngine(BaseCase):
+
+    def test_div_half_up(self):
+        # Halves are rounded away from zero, the same way for negative amounts.
+        self.assertEqual(global_tax_engine.div_half_up(5, 2), 3)
+        self.assertEqual(global_tax_engine.div_half_up(-5, 2), -3)
+        self.assertEqual(global_tax_engine.div_half_up(-6, 4), -2)
+        self.assertEqual(global_tax_engine.div_half_up(-5, 4), -1)
+        self.assertEqual(global_tax_engine.div_half_up(-7, 4), -2)
+
+    def test_apply_rate(self):
+        self.assertEqual(global_tax_engine.apply_rate(1033, global_tax_engine.rate_to_ppm(16.0)), 165)
+        self.assertEqual(global_tax_engine.apply_rate(-1033, global_tax_engine.rate_to_ppm(16.0)), -165)
+        self.assertEqual(global_tax_engine.apply_rate(3125, global_tax_engine.rate_to_ppm(16.0)), 500)
+        self.assertEqual(global_tax_engine.apply_rate(1000, global_tax_engine.rate_to_ppm(-10.6667)), -107)
+        self.assertEqual(global_tax_engine.apply_rate(-1000, global_tax_engine.rate_to_ppm(-10.6667)), 107)
+
+    def test_apply_currency_rate(self):
+        rate = global_tax_engine.currency_rate_to_fixed(17.123456)
+        # 123.45 * 17.123456 = 2113.8906432
+        self.assertEqual(global_tax_engine.apply_currency_rate(12345, rate, 2, 2), 211389)
+        self.assertEqual(global_tax_engine.apply_currency_rate(-12345, rate, 2, 2), -211389)
+        # To a currency without decimals.
+        rate = global_tax_engine.currency_rate_to_fixed(0.5)
+        self.assertEqual(global_tax_engine.apply_currency_rate(100, rate, 2, 0), 1)
+        self.assertEqual(global_tax_engine.apply_currency_rate(300, rate, 2, 0), 2)
+
+
+class TestGlobalTaxTotals(TransactionCase):
+
+    def _get_tax_context(self, currency_rate, balance_multiplicator):
+        def get_taxes_vals(rates):
+            return [{
+                'tax': None,
+                'amount': rate,
+                'rate_ppm': global_tax_engine.rate_to_ppm(rate),
+                'name': str(rate),
+                'cfdi_name': '002',
+            } for rate in rates]
+
+        return {
+            'balance_multiplicator': balance_multiplicator,
+            'currency_rate': currency_rate,
+            'currency_rate_fixed': global_tax_engine.currency_rate_to_fixed(currency_rate),
+            'currency_digits': 2,
+            'company_currency_digits': 2,
+            'transferred': {'total_tax_rate': 16.0, 'taxes': get_taxes_vals([16.0])},
+            'withholding': {'total_tax_rate': -20.6667, 'taxes': get_taxes_vals([-10.6667, -10.0])},
+        }
+
+    def test_totals_equal_sum_of_concepts(self):
+        price_subtotals = [10.33, 0.05, 99.99, 1234.57, 0.01]
+        global_line_model = self.env['account.global.line']
+        for currency_rate, balance_multiplicator in ((1.0, -1), (17.123456, -1), (17.123456, 1)):
+            tax_context = self._get_tax_context(currency_rate, balance_multiplicator)
+            for tax_type in ('transferred', 'withholding'):
+                totals = global_tax_engine.compute_tax_totals(price_subtotals, tax_context, tax_type)
+                tax_details = [
+                    tax_detail
+                    for price_subtotal in price_subtotals
+                    for tax_detail in global_line_model._get_global_tax_detail(price_subtotal, tax_context, tax_type)['tax_details']
+                ]
+                for key in ('base_amount_currency', 'tax_amount_currency', 'base_amount', 'tax_amount'):
+                    self.assertEqual(
+                        totals[key],
+                        sum(global_tax_engine.to_minor_units(tax_detail[key], 2) for tax_detail in tax_details),
+                        f"{key} of the {tax_type} taxes at the rate {currency_rate}",
+                    )
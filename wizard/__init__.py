@@ -0,0 +1 @@
+from . import account_global_line_import
@@ -0,0 +1,31 @@
+from odoo import api, models, fields
+
+
+class AccountGlobalLineImport(models.TransientModel):
+    _name = "account.global.line.import"
+    _description = "Import Global Lines"
+
+    move_id = fields.Many2one('account.move', string='Journal Entry', required=True, readonly=True)
+    date_from = fields.Date(string='Desde', required=True)
+    date_to = fields.Date(string='Hasta', required=True)
+    import_pos = fields.Boolean(string='Punto de Venta', default=lambda self: self._is_source_available('pos'))
+    import_sale = fields.Boolean(string='Ventas', default=lambda self: self._is_source_available('sale'))
+    batch_size = fields.Integer(string='Lote', default=1000, required=True)
+
+    @api.model
+    def _is_source_available(self, source):
+        sources = self.env['account.move']._get_global_line_import_sources()
+        return sources[source]['model'] in self.env
+
+    @api.model
+    def default_get(self, fields_list):
+        res = super().default_get(fields_list)
+        if 'move_id' in fields_list and not res.get('move_id') and self._context.get('active_model') == 'account.move':
+            res['move_id'] = self._context.get('active_id')
+        return res
+
+    def action_import(self):
+        self.ensure_one()
+        sources = [source for source, selected in (('pos', self.import_pos), ('sale', self.import_sale)) if selected]
+        self.move_id._import_global_lines(self.date_from, self.date_to, sources=sources, batch_size=self.batch_size)
+        return {'type': 'ir.actions.act_window_close'}